@@ -0,0 +1,123 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Deployment artifacts: stacks rendered once, applied many times
+
+"gpwm render --artifact out.json" writes the fully rendered stack (stack
+file and templates rendered, YAML tags resolved) to a JSON bundle, and
+"gpwm apply out.json" executes it without any templating or lookups:
+
+    {
+        "version": 1,
+        "provider": "cloudformation",
+        "deployments": [
+            {"region": "us-east-1", "attributes": {"StackName": ...}},
+            {"region": "eu-west-1", "attributes": {"StackName": ...}}
+        ],
+        "content_hash": "..."
+    }
+
+There is one deployment per region the stack was rendered for, or a single
+deployment with a null region for the default region. The attributes are
+what the stack classes' get_artifact() return. The content hash covers
+everything else in the bundle, so modified or truncated artifacts are
+rejected.
+"""
+
+import json
+
+import gpwm.caches
+import gpwm.stacks
+import gpwm.utils
+
+
+ARTIFACT_VERSION = 1
+
+
+def get_artifact_hash(artifact):
+    """ Returns the content hash of an artifact, ignoring its content_hash
+    """
+    content = {k: v for k, v in artifact.items() if k != "content_hash"}
+    return gpwm.caches.content_hash(
+        gpwm.utils.dump_json(content, sort_keys=True)
+    )
+
+
+def build_artifact(provider, stacks):
+    """ Builds the artifact of a rendered stack
+
+    Args:
+        provider(str): The stack type, as returned by
+            gpwm.stacks.get_stack_type()
+        stacks(list): Tuples with the region (or None) and the stack object
+            loaded for that region
+
+    Returns: The artifact as a dict of JSON data
+    """
+    deployments = [
+        {"region": region, "attributes": stack.get_artifact()}
+        for region, stack in stacks
+    ]
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "provider": provider,
+        # YAML nodes (Cloudformation intrinsics) and dates become JSON
+        "deployments": json.loads(gpwm.utils.dump_json(deployments))
+    }
+    artifact["content_hash"] = get_artifact_hash(artifact)
+    return artifact
+
+
+def write_artifact(path, provider, stacks):
+    """ Writes the artifact of a rendered stack to a file
+
+    See build_artifact()
+    """
+    artifact = build_artifact(provider, stacks)
+    gpwm.caches.write_file(
+        path,
+        gpwm.utils.dump_json(artifact, indent=2, separators=(",", ": "))
+    )
+    return artifact
+
+
+def read_artifact(path):
+    """ Reads and verifies an artifact written by write_artifact()
+
+    Returns: The artifact as a dict
+    """
+    try:
+        with open(path) as artifact_file:
+            artifact = json.load(artifact_file)
+    except (OSError, ValueError) as exc:
+        raise SystemExit(f"Can't read artifact {path}: {exc}")
+    if artifact.get("version") != ARTIFACT_VERSION:
+        raise SystemExit(
+            f"Unsupported artifact version: {artifact.get('version')}"
+        )
+    if artifact.get("content_hash") != get_artifact_hash(artifact):
+        raise SystemExit(f"Artifact content doesn't match its hash: {path}")
+    return artifact
+
+
+def load_stack(artifact, deployment):
+    """ Rebuilds the stack object of one of the deployments of an artifact
+
+    Args:
+        artifact(dict): The output of read_artifact()
+        deployment(dict): One of the artifact's deployments
+    """
+    stack_class = gpwm.stacks.get_stack_class(artifact["provider"])
+    return stack_class.from_artifact(deployment["attributes"])
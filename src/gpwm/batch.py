@@ -0,0 +1,242 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Dependency-aware execution of multiple stacks
+
+A batch is a directory (or a glob) of stack files. Each stack file is
+rendered by its templating engine and composed (but not constructed) by
+PyYAML, so the cross-stack YAML tags can be inspected without making any
+API calls. The tags form the edges of a dependency graph:
+
+    !Cloudformation {stack: vpc-demo-dev, output: VPC}
+    !ARM {resource-group: rg, deployment: vnet, output: vnet}
+    !GCPDM {project: dev, deployment: network, output: vpc}
+
+Stacks that don't depend on each other are executed concurrently by a
+bounded pool of workers. Dependencies on stacks outside of the batch are
+assumed to already exist and are ignored.
+"""
+
+from __future__ import print_function
+import concurrent.futures
+import glob
+import os
+
+import yaml
+
+import gpwm.utils
+
+
+STACK_FILE_EXTENSIONS = [".mako", ".jinja", ".yaml"]
+STACK_NAME_KEYS = ["StackName", "name"]
+TEMPLATE_KEYS = ["TemplateBody", "template"]
+DEPENDENCY_TAGS = {
+    "!Cloudformation": "stack",
+    "!ARM": "deployment",
+    "!GCPDM": "deployment"
+}
+
+
+def find_stack_files(path):
+    """ Returns the stack files represented by a path
+
+    Args:
+        path(str): A stack file, a directory or a glob pattern. Directories
+            are searched recursively for files with the extensions in
+            STACK_FILE_EXTENSIONS.
+
+    Returns: A sorted list of paths.
+    """
+    if os.path.isdir(path):
+        paths = []
+        for root, dirs, files in os.walk(path):
+            paths.extend(os.path.join(root, f) for f in files)
+    else:
+        paths = glob.glob(path, recursive=True)
+
+    stack_files = sorted(
+        p for p in paths if os.path.isfile(p) and
+        os.path.splitext(p)[1] in STACK_FILE_EXTENSIONS
+    )
+    if not stack_files:
+        raise SystemExit(f"No stack files found: {path}")
+    return stack_files
+
+
+def get_node_value(node, key):
+    """ Returns the scalar value of a key in a YAML mapping node
+    """
+    if not isinstance(node, yaml.MappingNode):
+        return None
+    for key_node, value_node in node.value:
+        if key_node.value == key and isinstance(value_node, yaml.ScalarNode):
+            return value_node.value
+    return None
+
+
+def get_templates(node):
+    """ Returns the paths/URLs of the templates used by a stack
+
+    Args:
+        node(yaml.Node): A composed YAML document
+
+    Returns: A list with the values of TemplateBody (AWS), template (Azure)
+        and every imports path (GCP)
+    """
+    templates = [get_node_value(node, key) for key in TEMPLATE_KEYS]
+    if isinstance(node, yaml.MappingNode):
+        for key_node, value_node in node.value:
+            if key_node.value == "imports" and \
+                    isinstance(value_node, yaml.SequenceNode):
+                templates.extend(
+                    get_node_value(i, "path") for i in value_node.value
+                )
+    return [t for t in templates if t]
+
+
+def get_dependencies(node):
+    """ Returns the names of the stacks referenced by gpwm's YAML tags
+
+    Args:
+        node(yaml.Node): A composed YAML document
+
+    Returns: A set with the stack/deployment names
+    """
+    dependencies = set()
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node.tag in DEPENDENCY_TAGS:
+            dependency = get_node_value(node, DEPENDENCY_TAGS[node.tag])
+            if dependency:
+                dependencies.add(dependency)
+        if isinstance(node, yaml.MappingNode):
+            for key_node, value_node in node.value:
+                nodes.extend([key_node, value_node])
+        elif isinstance(node, yaml.SequenceNode):
+            nodes.extend(node.value)
+    return dependencies
+
+
+class BatchStack(object):
+    """ A rendered stack file and its position in the dependency graph
+
+    Args:
+        path(str): The path to the stack file
+        rendered_template(str): The stack file after going through the
+            templating engine
+    """
+    def __init__(self, path, rendered_template):
+        self.path = path
+        self.rendered_template = rendered_template
+
+        document = yaml.compose(rendered_template, Loader=gpwm.utils.Loader)
+        self.name = path
+        for key in STACK_NAME_KEYS:
+            name = get_node_value(document, key)
+            if name:
+                self.name = name
+                break
+        self.dependencies = get_dependencies(document)
+        self.dependencies.discard(self.name)
+        self.templates = get_templates(document)
+
+
+def build_graph(stacks, reverse=False):
+    """ Builds the dependency graph of a batch of stacks
+
+    Args:
+        stacks(list): BatchStack objects
+        reverse(bool): If True, the edges of the graph are reversed, ie
+            a stack depends on the stacks that depend on it. Used for
+            deletes.
+
+    Returns: A dict mapping each stack name to the set of names of
+        stacks in the batch that must be completed first.
+    """
+    graph = {}
+    for stack in stacks:
+        if stack.name in graph:
+            raise SystemExit(f"Duplicate stack in batch: {stack.name}")
+        graph[stack.name] = set()
+
+    for stack in stacks:
+        for dependency in stack.dependencies:
+            if dependency not in graph:
+                continue
+            if reverse:
+                graph[dependency].add(stack.name)
+            else:
+                graph[stack.name].add(dependency)
+
+    # Kahn's algorithm, only to detect cycles before anything is executed
+    pending = {k: set(v) for k, v in graph.items()}
+    while pending:
+        ready = [k for k, v in pending.items() if not v]
+        if not ready:
+            raise SystemExit(
+                f"Circular dependency between stacks: {sorted(pending)}"
+            )
+        for name in ready:
+            del pending[name]
+        for dependencies in pending.values():
+            dependencies.difference_update(ready)
+    return graph
+
+
+def run(graph, function, workers=4):
+    """ Executes a function for every stack in the graph
+
+    A stack is submitted to the pool of workers as soon as all its
+    dependencies completed successfully. When a stack fails, nothing else is
+    submitted, the stacks already running are waited for, and the batch
+    exits with an error listing the failed and skipped stacks.
+
+    Args:
+        graph(dict): The output of build_graph()
+        function(callable): Called with the stack name as only argument
+        workers(int): The maximum number of stacks running concurrently
+    """
+    pending = {k: set(v) for k, v in graph.items()}
+    failed = {}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            if not failed:
+                ready = [k for k, v in pending.items() if not v]
+                for name in ready:
+                    del pending[name]
+                    running[pool.submit(function, name)] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    failed[name] = exc
+                    continue
+                for dependencies in pending.values():
+                    dependencies.discard(name)
+
+    if failed:
+        for name, exc in sorted(failed.items()):
+            print(f"===> {name} failed: {exc}")
+        if pending:
+            print(f"===> Skipped: {', '.join(sorted(pending))}")
+        raise SystemExit(f"{len(failed)} stack(s) failed")
@@ -0,0 +1,147 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" On-disk caches shared across gpwm runs
+
+All caches live under GPWM_CACHE_DIR (defaults to ~/.cache/gpwm), one
+subdirectory per cache. Setting GPWM_NO_CACHE to any non-empty value disables
+every on-disk cache.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def get_cache_dir(*names):
+    """ Returns the directory of a cache, creating it if needed
+
+    Args:
+        names(str): The subdirectories of the cache, for example
+            get_cache_dir("mako", mako.__version__)
+
+    Returns: The path to the directory, or None if caching is disabled
+    """
+    if os.environ.get("GPWM_NO_CACHE"):
+        return None
+    root = os.environ.get("GPWM_CACHE_DIR") or \
+        os.path.join(os.path.expanduser("~"), ".cache", "gpwm")
+    path = os.path.join(root, *names)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def content_hash(*parts):
+    """ Returns a hex digest identifying the content of all parts
+
+    Args:
+        parts: strings, bytes or anything with a deterministic repr()
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def get_file_name(key):
+    """ Returns the name of the file caching a key in a JsonCache
+    """
+    return f"{content_hash(key)}.json"
+
+
+def delete_key(key, *names):
+    """ Deletes a key from all the caches under a cache directory
+
+    Args:
+        key(str): The key of the value
+        names(str): The subdirectories of the caches, for example
+            delete_key("vpc", "outputs") deletes the outputs cached for the
+            "vpc" stack/deployment of every provider and scope
+    """
+    path = get_cache_dir(*names)
+    if not path:
+        return
+    file_name = get_file_name(key)
+    for root, dirs, files in os.walk(path):
+        if file_name in files:
+            try:
+                os.unlink(os.path.join(root, file_name))
+            except FileNotFoundError:
+                pass
+
+
+def write_file(path, content):
+    """ Atomically writes a cache file
+
+    The content is written to a temporary file that is renamed into place,
+    so concurrent readers never see a partially written file.
+    """
+    mode = "wb" if isinstance(content, bytes) else "w"
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode) as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class JsonCache(object):
+    """ A cache of JSON serializable values, one file per key
+
+    Args:
+        names(str): The subdirectories of the cache, see get_cache_dir()
+
+    If caching is disabled, nothing is ever found in the cache and nothing
+    is written to it.
+    """
+    def __init__(self, *names):
+        self.path = get_cache_dir(*names)
+
+    def _get_path(self, key):
+        return os.path.join(self.path, get_file_name(key))
+
+    def get(self, key, ttl=None):
+        """ Returns a cached value, or None if not cached
+
+        Args:
+            key(str): The key of the value
+            ttl(float): If given, values cached more than ttl seconds ago
+                are ignored
+        """
+        if not self.path:
+            return None
+        try:
+            with open(self._get_path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if ttl is not None and time.time() - entry["cached_at"] > ttl:
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        """ Caches a value
+        """
+        if self.path:
+            entry = {"cached_at": time.time(), "value": value}
+            write_file(self._get_path(key), json.dumps(entry))
@@ -19,26 +19,37 @@
 
 from __future__ import print_function
 import argparse
+import concurrent.futures
+import copy
 import logging
 import os
 import sys
-import yaml
+import threading
 
-import jinja2
 import mako.exceptions
-import mako.template
 
+import gpwm.artifacts
+import gpwm.batch
+import gpwm.renderers
+import gpwm.sessions
 import gpwm.utils
 import gpwm.stacks
 
 
+# One semaphore per region and size, shared by all stacks deployed to that
+# region
+REGION_SEMAPHORES = {}
+REGION_SEMAPHORES_LOCK = threading.Lock()
+
+
 def build_common_args(parser):
     """ Configures arguments to all actions/subparsers
     """
     parser.add_argument(
         "stack",
-        type=argparse.FileType("r"),
-        help=("The path to the stack file. "
+        type=str,
+        help=("The path to the stack file, or a directory/glob of stack "
+              "files to be executed in dependency order. "
               "Use - for stdin, in which case -t must be specified")
     )
     parser.add_argument(
@@ -63,6 +74,31 @@ def build_common_args(parser):
         default=os.getenv("BUILD_ID", ""),
         help="The build id. Defaults to BUILD_ID env variable"
     )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=int(os.getenv("GPWM_WORKERS", "4")),
+        help=("The maximum number of stacks executed concurrently when "
+              "a directory or glob is given. Defaults to GPWM_WORKERS "
+              "env variable or 4")
+    )
+    parser.add_argument(
+        "--regions",
+        type=lambda regions: [r.strip() for r in regions.split(",") if r],
+        default=os.getenv("GPWM_REGIONS"),
+        help=("Comma-separated AWS regions the stack is deployed to, "
+              "overriding the Regions attribute of the stack file. "
+              "Defaults to GPWM_REGIONS env variable")
+    )
+    parser.add_argument(
+        "--region-workers",
+        type=int,
+        default=int(os.getenv("GPWM_REGION_WORKERS", "4")),
+        help=("The maximum number of stacks executed concurrently in the "
+              "same region. Defaults to GPWM_REGION_WORKERS env variable "
+              "or 4")
+    )
 
 
 def parse_args(args):
@@ -90,6 +126,37 @@ def parse_args(args):
 
     # subparser for each action
     subparser_obj = parser.add_subparsers(dest="action")
+    # apply doesn't take a stack file, so no common arguments
+    apply_parser = subparser_obj.add_parser("apply")
+    apply_parser.add_argument(
+        "artifact",
+        type=str,
+        help="The path to an artifact written by render --artifact"
+    )
+    apply_parser.add_argument(
+        "--action",
+        "-a",
+        dest="apply_action",
+        choices=["create", "update", "upsert", "delete", "validate"],
+        default="upsert",
+        help="The action executed with the artifact. Defaults to upsert"
+    )
+    apply_parser.add_argument(
+        "--wait",
+        "-w",
+        action="store_true",
+        default=False,
+        help="Waits for the stack to be ready/deleted before exiting"
+    )
+    apply_parser.add_argument(
+        "--region-workers",
+        type=int,
+        default=int(os.getenv("GPWM_REGION_WORKERS", "4")),
+        help=("The maximum number of stacks executed concurrently in the "
+              "same region. Defaults to GPWM_REGION_WORKERS env variable "
+              "or 4")
+    )
+
     actions = [
         "create",
         "update",
@@ -113,7 +180,16 @@ def parse_args(args):
         "-r",
         action="store_true",
         default=False,
-        help="Review changes"
+        help=("Review changes. The change set is executed, kept or deleted "
+              "according to GPWM_CHANGE_SET_POLICY, or by asking the user")
+    )
+
+    # render
+    subparsers["render"].add_argument(
+        "--artifact",
+        type=str,
+        help=("Writes the fully rendered stack to this file instead of "
+              "printing it, to be executed later by the apply action")
     )
 
     # upsert
@@ -122,7 +198,8 @@ def parse_args(args):
         "-r",
         action="store_true",
         default=False,
-        help="Review changes"
+        help=("Review changes. The change set is executed, kept or deleted "
+              "according to GPWM_CHANGE_SET_POLICY, or by asking the user")
     )
 
     return parser.parse_args(args)
@@ -158,8 +235,11 @@ def execute_action(stack, args, stack_attributes):
     elif args.action == "upsert":
         stack.upsert(wait=args.wait)
     elif args.action == "render":
+        # the artifact is written by main() once all regions are loaded
+        if getattr(args, "artifact", None):
+            return
         print("===> Stack Attributes:")
-        print(yaml.dump(stack_attributes, indent=2))
+        print(gpwm.utils.dump_yaml(stack_attributes, indent=2))
         print("===> Final Template:")
         stack.render()
     elif args.action == "list":
@@ -170,31 +250,13 @@ def execute_action(stack, args, stack_attributes):
         raise NotImplementedError("Action not implemented")
 
 
-def main():
-    """ Entry point
-    """
-    args = parse_args(sys.argv[1:])
+def render_stack_file(stack_file, templating_engine, build_id):
+    """ Renders a stack file with its templating engine
 
-    if not args.build_id:
-        raise SystemExit("The build ID is required. "
-                         "Use -b option or set BUILD_ID")
-
-    # logging
-    loglevel = getattr(logging, args.loglevel.upper(), None)
-    botocore_loglevel = getattr(logging, args.botocore_loglevel.upper(), None)
-
-    # botocore logging level
-    boto_logger = logging.getLogger("botocore")
-    boto_logger.setLevel(level=botocore_loglevel)
-
-    # script logging level
-    logging.basicConfig(level=loglevel)
-
-    templating_engine = resolve_templating_engine(args)
-
-    stack_file = args.stack.read()
+    Returns: The rendered stack file as a string
+    """
     template_params = {
-        "build_id": args.build_id,
+        "build_id": build_id,
         "utils": gpwm.utils
     }
 
@@ -204,26 +266,263 @@ def main():
 
     if templating_engine == "mako":
         logging.debug("Trying to render mako input file...")
-        stack_template = mako.template.Template(
+        stack_template = gpwm.renderers.get_mako_template(
             stack_file,
             strict_undefined=True
         )
         try:
-            rendered_template = stack_template.render(**template_params)
+            return stack_template.render(**template_params)
         # mako wraps the exception where the real information is, so we unwrap
         # and display only the part that matters to the user
         except Exception:
             raise SystemExit(mako.exceptions.text_error_template().render())
     elif templating_engine == "jinja":
-        stack_template = jinja2.Template(stack_file)
-        rendered_template = stack_template.render(**template_params)
-    else:
-        rendered_template = stack_file
+        stack_template = gpwm.renderers.get_jinja_template(stack_file)
+        return stack_template.render(**template_params)
+    return stack_file
+
 
-    stack_attributes = yaml.load(rendered_template)
-    stack_attributes["BuildId"] = args.build_id
+def load_stack(document, build_id):
+    """ Loads a stack file into a stack object
+
+    Args:
+        document(dict): The rendered stack file, loaded with load_yaml().
+            The stack is built from a copy of it, as the stack classes
+            modify their attributes (Tags, labels...), so it can be loaded
+            once per region.
+        build_id(str): The build id
+
+    Returns: A tuple with the stack object and the stack attributes
+    """
+    stack_attributes = gpwm.utils.resolve_tags(copy.deepcopy(document))
+    stack_attributes.pop("Regions", None)
+    stack_attributes["BuildId"] = build_id
     stack = gpwm.stacks.factory(**stack_attributes)
-    execute_action(stack, args, stack_attributes)
+    return stack, stack_attributes
+
+
+def get_region_semaphore(region, workers):
+    """ Returns the semaphore capping the stacks running in a region
+    """
+    key = (region, workers)
+    with REGION_SEMAPHORES_LOCK:
+        if key not in REGION_SEMAPHORES:
+            REGION_SEMAPHORES[key] = threading.BoundedSemaphore(workers)
+        return REGION_SEMAPHORES[key]
+
+
+def run_in_regions(regions, function, workers):
+    """ Calls a function in multiple AWS regions concurrently
+
+    Each call runs in its own thread, in the region set by
+    gpwm.sessions.aws_region(), with at most workers calls running in the
+    same region at a time.
+
+    Args:
+        regions(list): The region names
+        function(callable): Called with the region as only argument
+        workers(int): The maximum number of calls running concurrently in
+            the same region
+
+    Returns: A list with the results of the calls, in the same order as
+        the regions
+    """
+    def execute(region):
+        semaphore = get_region_semaphore(region, workers)
+        with semaphore, gpwm.sessions.aws_region(region):
+            return function(region)
+
+    with concurrent.futures.ThreadPoolExecutor(len(regions)) as pool:
+        futures = {pool.submit(execute, region): region for region in regions}
+
+    failed = {
+        futures[future]: future.exception()
+        for future in futures if future.exception() is not None
+    }
+    if failed:
+        for region, exc in sorted(failed.items()):
+            print(f"===> {region} failed: {exc}")
+        raise SystemExit(f"{len(failed)} region(s) failed")
+    return [future.result() for future in futures]
+
+
+def execute_stack(args, rendered_template):
+    """ Loads and executes a rendered stack file in all its regions
+
+    The regions come from --regions or the Regions attribute of the stack
+    file. Without regions, the stack is executed once in the default region
+    of the AWS session. Otherwise the stack is loaded and executed in every
+    region concurrently, each in its own session, with at most
+    --region-workers stacks running in the same region at a time. YAML
+    tags are resolved (and cached) in the region the stack is executed in.
+
+    Returns: A tuple with the stack type and a list of tuples with each
+        region (None for the default region) and its stack object
+    """
+    document = gpwm.utils.load_yaml(rendered_template)
+    stack_type = gpwm.stacks.get_stack_type(document)
+    regions = getattr(args, "regions", None) or document.get("Regions")
+    # a single region, or comma-separated regions like --regions
+    if isinstance(regions, str):
+        regions = [r.strip() for r in regions.split(",") if r.strip()]
+    elif regions and not isinstance(regions, list):
+        raise SystemExit(f"Regions must be a list of regions: {regions}")
+    if not regions:
+        stack, stack_attributes = load_stack(document, args.build_id)
+        execute_action(stack, args, stack_attributes)
+        return stack_type, [(None, stack)]
+
+    if stack_type != "cloudformation":
+        raise SystemExit("Regions are only supported by Cloudformation stacks")
+
+    def execute(region):
+        print(f"===> {args.action} in {region}")
+        stack, stack_attributes = load_stack(document, args.build_id)
+        execute_action(stack, args, stack_attributes)
+        return region, stack
+
+    return stack_type, run_in_regions(regions, execute, args.region_workers)
+
+
+def apply_artifact(args):
+    """ Executes an action with the stacks of an artifact
+
+    No templates are rendered and no YAML tags are resolved, everything
+    comes from the artifact written by render --artifact. Deployments to
+    multiple regions are executed concurrently, like execute_stack() does.
+    """
+    artifact = gpwm.artifacts.read_artifact(args.artifact)
+    action_args = argparse.Namespace(
+        action=args.apply_action,
+        wait=args.wait,
+        review=False
+    )
+
+    def execute(deployment):
+        stack = gpwm.artifacts.load_stack(artifact, deployment)
+        execute_action(stack, action_args, deployment["attributes"])
+
+    deployments = artifact["deployments"]
+    regions = [d["region"] for d in deployments if d["region"]]
+    if not regions:
+        for deployment in deployments:
+            execute(deployment)
+        return
+
+    by_region = {d["region"]: d for d in deployments}
+
+    def execute_region(region):
+        print(f"===> {args.apply_action} in {region}")
+        execute(by_region[region])
+
+    run_in_regions(regions, execute_region, args.region_workers)
+
+
+def execute_batch(args, paths):
+    """ Executes the action for multiple stack files
+
+    The stack files are rendered up front, so the dependencies between
+    them and the remote templates they use (which are prefetched
+    concurrently) are known before any stack is loaded. Loading a stack
+    resolves its YAML tags, so that only happens once all its dependencies
+    are done. Stacks with dependents in the batch are waited for even
+    without --wait.
+    """
+    # upserts of existing Cloudformation stacks always review changes
+    policy = os.environ.get("GPWM_CHANGE_SET_POLICY", "prompt")
+    reviews = getattr(args, "review", False) or args.action == "upsert"
+    if reviews and policy == "prompt":
+        raise SystemExit(
+            f"{args.action} with multiple stacks reviews changes, and "
+            "requires a non-interactive GPWM_CHANGE_SET_POLICY"
+        )
+
+    batch = []
+    for path in paths:
+        with open(path) as stack_file:
+            stack_args = argparse.Namespace(**vars(args))
+            stack_args.stack = stack_file
+            templating_engine = resolve_templating_engine(stack_args)
+            rendered_template = render_stack_file(
+                stack_file.read(),
+                templating_engine,
+                args.build_id
+            )
+        batch.append(gpwm.batch.BatchStack(path, rendered_template))
+
+    # fails on duplicate stack names, before they're indexed by name
+    graph = gpwm.batch.build_graph(batch, reverse=args.action == "delete")
+    stacks = {stack.name: stack for stack in batch}
+
+    gpwm.renderers.prefetch_templates(
+        [t for stack in batch for t in stack.templates],
+        workers=args.workers
+    )
+    # stacks are validated independently, so they don't wait for each other
+    if args.action == "validate":
+        graph = {name: set() for name in graph}
+
+    # the actions return as soon as the API accepts them, so stacks other
+    # stacks depend on are always waited for
+    required = set().union(*graph.values())
+
+    def execute(name):
+        print(f"===> {args.action}: {name} ({stacks[name].path})")
+        stack_args = argparse.Namespace(**vars(args))
+        stack_args.wait = args.wait or name in required
+        execute_stack(stack_args, stacks[name].rendered_template)
+        # the stacks depending on this one must see its new outputs
+        if args.action in ["create", "update", "upsert", "delete"]:
+            gpwm.utils.forget_stack(name)
+        print(f"===> {args.action} done: {name}")
+
+    gpwm.batch.run(graph, execute, workers=args.workers)
+
+
+def main():
+    """ Entry point
+    """
+    args = parse_args(sys.argv[1:])
+
+    if args.action != "apply" and not args.build_id:
+        raise SystemExit("The build ID is required. "
+                         "Use -b option or set BUILD_ID")
+
+    # logging
+    loglevel = getattr(logging, args.loglevel.upper(), None)
+    botocore_loglevel = getattr(logging, args.botocore_loglevel.upper(), None)
+
+    # botocore logging level
+    boto_logger = logging.getLogger("botocore")
+    boto_logger.setLevel(level=botocore_loglevel)
+
+    # script logging level
+    logging.basicConfig(level=loglevel)
+
+    if args.action == "apply":
+        apply_artifact(args)
+        return
+
+    if args.stack == "-":
+        args.stack = sys.stdin
+    elif os.path.isfile(args.stack):
+        args.stack = open(args.stack)
+    elif getattr(args, "artifact", None):
+        raise SystemExit("--artifact requires a single stack file")
+    else:
+        execute_batch(args, gpwm.batch.find_stack_files(args.stack))
+        return
+
+    templating_engine = resolve_templating_engine(args)
+    rendered_template = render_stack_file(
+        args.stack.read(),
+        templating_engine,
+        args.build_id
+    )
+    stack_type, stacks = execute_stack(args, rendered_template)
+    if getattr(args, "artifact", None):
+        gpwm.artifacts.write_artifact(args.artifact, stack_type, stacks)
+        print(f"===> Artifact written to {args.artifact}")
 
 
 if __name__ == "__main__":
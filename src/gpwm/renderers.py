@@ -15,20 +15,43 @@
 
 """ Miscelaneous rendering functions """
 
+import concurrent.futures
+import json
 import os
-import requests
 from six.moves.urllib.parse import parse_qs
 from six.moves.urllib.parse import urlparse
+import threading
+import time
 import yaml
 
-import boto3
 import jinja2
+import mako
 import mako.exceptions
 import mako.template
 
+import gpwm.caches
+import gpwm.sessions
 import gpwm.utils
 
 
+REMOTE_SCHEMES = ["http", "https", "s3"]
+PREFETCHED_TEMPLATES = {}
+CONNECTIONS = threading.local()
+
+
+def get_template_url(url):
+    """ Returns the URL of a template after applying GPWM_TEMPLATE_URL_PREFIX
+    """
+    url_prefix = os.environ.get("GPWM_TEMPLATE_URL_PREFIX", "")
+    if url_prefix:
+        if url_prefix.endswith("/"):
+            url_prefix = url_prefix[:-1]
+        if url.startswith("/"):
+            url = url[1:]
+        url = f"{url_prefix}/{url}"
+    return url
+
+
 def get_template_body(url):
     """ Returns the text of the URL
 
@@ -41,35 +64,17 @@ def get_template_body(url):
         - http/https
         - s3
         - path
-    """
-    url_prefix = os.environ.get("GPWM_TEMPLATE_URL_PREFIX", "")
-    if url_prefix:
-        if url_prefix.endswith("/"):
-            url_prefix = url_prefix[:-1]
-        if url.startswith("/"):
-            url = url[1:]
-        url = f"{url_prefix}/{url}"
 
+    Remote templates (http/https and s3) go through the template cache, see
+    get_remote_template_body(), unless they were already downloaded by
+    prefetch_templates().
+    """
+    url = get_template_url(url)
     parsed_url = urlparse(url)
-    if "http" in parsed_url.scheme:  # http and https
-        try:
-            request = requests.get(url)
-            request.raise_for_status()
-            body = request.text
-        except requests.exceptions.RequestException as exc:
-            raise SystemExit(exc)
-    elif parsed_url.scheme == "s3":
-        s3 = boto3.resource("s3")
-        obj = s3.Object(parsed_url.netloc, parsed_url.path[1:])
-        extra_args = {k: v[0] for k, v in parse_qs(parsed_url.query).items()}
-        try:
-            body = obj.get(**extra_args)["Body"].read()
-        except s3.meta.client.exceptions.NoSuchBucket as exc:
-            raise SystemExit(
-                f"Error: S3 bucket doesn't exist: {parsed_url.netloc}"
-            )
-        except s3.meta.client.exceptions.NoSuchKey as exc:
-            raise SystemExit(f"Error: S3 object doesn't exist: {url}")
+    if url in PREFETCHED_TEMPLATES:
+        body = PREFETCHED_TEMPLATES[url]
+    elif parsed_url.scheme in REMOTE_SCHEMES:
+        body = get_remote_template_body(url, parsed_url)
     elif not parsed_url.scheme:
         with open(url) as local_file:
             body = local_file.read()
@@ -79,12 +84,310 @@ def get_template_body(url):
     return parsed_url, body
 
 
+def prefetch_templates(urls, workers=8):
+    """ Downloads remote templates concurrently
+
+    The templates are kept in memory for the lifetime of the process, so
+    get_template_body() doesn't have to wait on the network when the
+    stacks are rendered. Local paths are ignored.
+
+    Args:
+        urls(iterable): Template paths/URLs, as they appear in the stacks
+        workers(int): The maximum number of concurrent downloads
+    """
+    remote_urls = set()
+    for url in urls:
+        url = get_template_url(url)
+        scheme = urlparse(url).scheme
+        if url not in PREFETCHED_TEMPLATES and scheme in REMOTE_SCHEMES:
+            remote_urls.add(url)
+    if not remote_urls:
+        return
+
+    def prefetch(url):
+        body = get_remote_template_body(url, urlparse(url))
+        PREFETCHED_TEMPLATES[url] = body
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the first exception of the downloads, if any
+        list(pool.map(prefetch, sorted(remote_urls)))
+
+
+def get_http_session():
+    """ Returns the HTTP session of the current thread
+
+    Sessions keep connections alive between requests, and retry failed
+    requests with exponential backoff (GPWM_HTTP_RETRIES times, defaults to
+    3).
+    """
+    if not hasattr(CONNECTIONS, "http"):
+        import requests
+        from requests.packages.urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=int(os.environ.get("GPWM_HTTP_RETRIES", "3")),
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        CONNECTIONS.http = requests.Session()
+        CONNECTIONS.http.mount("http://", adapter)
+        CONNECTIONS.http.mount("https://", adapter)
+    return CONNECTIONS.http
+
+
+def get_s3_client():
+    """ Returns the S3 client used to fetch templates
+
+    The client comes from the shared pool in gpwm.sessions.AWSClients.
+    """
+    return gpwm.sessions.AWSClients().get("s3")
+
+
+def get_remote_template_body(url, parsed_url):
+    """ Returns the text of a remote template, using the template cache
+
+    Every remote template is stored in the "templates" cache with its ETag
+    and Last-Modified headers. A cached template is used as is if it was
+    fetched less than GPWM_TEMPLATE_CACHE_TTL seconds ago (defaults to 0),
+    otherwise it's revalidated with a conditional request, and only
+    downloaded again if it changed.
+
+    If GPWM_OFFLINE is set, cached templates are always used and templates
+    not in the cache are an error.
+
+    Objects encrypted with customer keys (SSECustomerKey) are never cached.
+
+    Args:
+        url(str): The URL of the template
+        parsed_url(ParseResult): The parsed URL
+
+    Returns: The text of the template
+    """
+    extra_args = {k: v[0] for k, v in parse_qs(parsed_url.query).items()}
+    cache_dir = None
+    if "SSECustomerKey" not in extra_args:
+        cache_dir = gpwm.caches.get_cache_dir("templates")
+
+    cached = None
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir,
+            f"{gpwm.caches.content_hash(url)}.json"
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+
+    ttl = float(os.environ.get("GPWM_TEMPLATE_CACHE_TTL", "0"))
+    if os.environ.get("GPWM_OFFLINE"):
+        if not cached:
+            raise SystemExit(f"Offline and template not cached: {url}")
+        return cached["body"]
+    if cached and time.time() - cached["fetched_at"] < ttl:
+        return cached["body"]
+
+    if parsed_url.scheme in ["http", "https"]:
+        template = fetch_http_template(url, cached)
+    else:
+        template = fetch_s3_template(url, parsed_url, extra_args, cached)
+
+    if cache_dir:
+        template["fetched_at"] = time.time()
+        gpwm.caches.write_file(cache_path, json.dumps(template))
+    return template["body"]
+
+
+def fetch_http_template(url, cached=None):
+    """ Downloads a template from a web server
+
+    Args:
+        url(str): The http or https URL of the template
+        cached(dict): The cached template. If given, the request is
+            conditional and the cached template is returned if the
+            template didn't change.
+
+    Returns: A dict with the template body, and its ETag and Last-Modified
+        headers.
+    """
+    import requests
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        request = get_http_session().get(url, headers=headers)
+        if cached and request.status_code == 304:
+            return cached
+        request.raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        raise SystemExit(exc)
+    return {
+        "body": request.text,
+        "etag": request.headers.get("ETag"),
+        "last_modified": request.headers.get("Last-Modified")
+    }
+
+
+def fetch_s3_template(url, parsed_url, extra_args, cached=None):
+    """ Downloads a template from S3
+
+    Args:
+        url(str): The s3 URL of the template
+        parsed_url(ParseResult): The parsed URL
+        extra_args(dict): Extra arguments to S3's GetObject call, from the
+            URL query string
+        cached(dict): The cached template. If given, the request is
+            conditional (IfNoneMatch) and the cached template is returned if
+            the template didn't change.
+
+    Returns: A dict with the template body and its ETag
+    """
+    from botocore.exceptions import ClientError
+
+    s3 = get_s3_client()
+    if cached and cached.get("etag"):
+        extra_args = dict(extra_args, IfNoneMatch=cached["etag"])
+    try:
+        response = s3.get_object(
+            Bucket=parsed_url.netloc,
+            Key=parsed_url.path[1:],
+            **extra_args
+        )
+    except s3.exceptions.NoSuchBucket:
+        raise SystemExit(
+            f"Error: S3 bucket doesn't exist: {parsed_url.netloc}"
+        )
+    except s3.exceptions.NoSuchKey:
+        raise SystemExit(f"Error: S3 object doesn't exist: {url}")
+    except ClientError as exc:
+        if cached and exc.response["Error"]["Code"] in ["304", "NotModified"]:
+            return cached
+        raise
+
+    body = response["Body"].read()
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    return {"body": body, "etag": response.get("ETag")}
+
+
+class TemplateLoader(jinja2.BaseLoader):
+    """ Jinja loader resolving template names with get_template_body()
+
+    Makes {% include %}, {% import %} and {% extends %} work with the same
+    paths and URLs (and GPWM_TEMPLATE_URL_PREFIX) as the TemplateBody of a
+    stack.
+    """
+    def get_source(self, environment, template):
+        parsed_url, body = get_template_body(template)
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        if parsed_url.scheme:
+            return body, None, lambda: True
+        path = parsed_url.path
+        mtime = os.path.getmtime(path)
+        return body, path, lambda: os.path.getmtime(path) == mtime
+
+
+JINJA_ENVIRONMENTS = {}
+
+
+def get_jinja_environment():
+    """ Returns the Jinja environment shared by all templates
+
+    The environment resolves templates with TemplateLoader and keeps a
+    bytecode cache in the "jinja" cache directory. One environment exists
+    per cache directory.
+    """
+    cache_dir = gpwm.caches.get_cache_dir("jinja", jinja2.__version__)
+    if cache_dir not in JINJA_ENVIRONMENTS:
+        bytecode_cache = None
+        if cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        JINJA_ENVIRONMENTS[cache_dir] = jinja2.Environment(
+            loader=TemplateLoader(),
+            bytecode_cache=bytecode_cache
+        )
+    return JINJA_ENVIRONMENTS[cache_dir]
+
+
+def get_jinja_template(template_body):
+    """ Returns a Jinja template, reusing bytecode compiled by previous runs
+
+    Jinja only uses the bytecode cache for templates coming from a loader,
+    so templates given as text are looked up in the cache by their content
+    hash here, the same way jinja2.BaseLoader.load() does it.
+
+    Args:
+        template_body(str): The text of the template
+
+    Returns: A jinja2.Template object
+    """
+    environment = get_jinja_environment()
+    bytecode_cache = environment.bytecode_cache
+    name = gpwm.caches.content_hash(template_body)
+
+    code = None
+    if bytecode_cache is not None:
+        bucket = bytecode_cache.get_bucket(
+            environment,
+            name,
+            None,
+            template_body
+        )
+        code = bucket.code
+    if code is None:
+        code = environment.compile(template_body, name)
+        if bytecode_cache is not None:
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+    return environment.template_class.from_code(
+        environment,
+        code,
+        environment.make_globals(None)
+    )
+
+
+def get_mako_template(template_body, **kwargs):
+    """ Returns a Mako template, reusing modules compiled by previous runs
+
+    Mako only caches compiled modules for templates loaded from files, so
+    the template body is stored in the "mako" cache under its content hash,
+    and Mako compiles it into the cache's module directory. The key
+    includes the Mako version and the template options, as both change
+    the generated code.
+
+    Args:
+        template_body(str): The text of the template
+        kwargs(dict): Keyword arguments to mako.template.Template()
+
+    Returns: A mako.template.Template object
+    """
+    cache_dir = gpwm.caches.get_cache_dir("mako", mako.__version__)
+    if not cache_dir:
+        return mako.template.Template(template_body, **kwargs)
+
+    key = gpwm.caches.content_hash(template_body, sorted(kwargs.items()))
+    path = os.path.join(cache_dir, f"{key}.mako")
+    if not os.path.exists(path):
+        gpwm.caches.write_file(path, template_body)
+    return mako.template.Template(
+        filename=path,
+        module_directory=os.path.join(cache_dir, "modules"),
+        uri=key,
+        **kwargs
+    )
+
+
 def parse_mako(stack_name, template_body, parameters):
     """ Parses Mako templates
     """
     # The default for strict_undefined is False. Change to True to
     # troubleshoot pesky templates
-    mako_template = mako.template.Template(
+    mako_template = get_mako_template(
         template_body,
         strict_undefined=False
     )
@@ -104,10 +407,11 @@ def parse_mako(stack_name, template_body, parameters):
     # Ignoring yaml tags unknown to this script, because one might want to use
     # the providers tags like !Ref, !Sub, etc in their templates
     try:
-        template = yaml.load(rendered_mako_template)
+        template = gpwm.utils.load_yaml(rendered_mako_template)
     except yaml.constructor.ConstructorError as exc:
         if "could not determine a constructor for the tag" not in exc.problem:
             raise exc
+    template = gpwm.utils.resolve_tags(template)
     # Automatically adds and merges outputs for every resource in the
     # template - outputs are automatically exported.
     # An existing output in the template will not be overriden by an
@@ -127,18 +431,19 @@ def parse_mako(stack_name, template_body, parameters):
 def parse_jinja(stack_name, template_body, parameters):
     """ Parses Jinja templates
     """
-    jinja_template = jinja2.Template(template_body)
+    jinja_template = get_jinja_template(template_body)
     parameters["utils"] = gpwm.utils
 #    parameters["get_stack_output"] = get_stack_output
 #    parameters["get_stack_resource"] = get_stack_resource
 #    parameters["call_aws"] = call_aws
     try:
-        template = yaml.load(jinja_template.render(**parameters))
+        template = gpwm.utils.load_yaml(jinja_template.render(**parameters))
     # Ignoring yaml tags unknown to this script, because one might want to use
     # the providers tags like !Ref, !Sub, etc in their templates
     except yaml.constructor.ConstructorError as exc:
         if "could not determine a constructor for the tag" not in exc.problem:
             raise exc
+    template = gpwm.utils.resolve_tags(template)
     # Automatically adds and merges outputs for every resource in the
     # template - outputs are automatically exported.
     # An existing output in the template will not be overriden by an
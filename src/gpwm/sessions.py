@@ -14,18 +14,20 @@
 
 
 """ Session and connection handlers for the cloud provider's APIs
+
+The provider SDKs are imported only when a session for that provider is
+actually used, so the SDKs for multiple providers don't need to be installed
+(or paid for at startup) if never used.
 """
 
+import collections
+import contextlib
 import importlib
 import os
+import threading
 import uuid
 
-import apiclient.discovery  # GCP API
-from azure.common.client_factory import get_client_from_auth_file
-from azure.common.client_factory import get_client_from_cli_profile
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.resource import SubscriptionClient
-import boto3
+import gpwm.caches
 
 
 class Singleton:
@@ -39,20 +41,125 @@ class Singleton:
         return cls._instance
 
 
+_aws_region = threading.local()
+
+
+def get_aws_region():
+    """ Returns the AWS region set by aws_region() for the current thread
+
+    Returns: The region name, or None for the default region of the
+        environment/profile
+    """
+    return getattr(_aws_region, "name", None)
+
+
+@contextlib.contextmanager
+def aws_region(region):
+    """ Sets the AWS region of the current thread
+
+    Clients from AWSClients (and so the AWS session, call_aws and the
+    YAML tags) default to this region while in the context. Used to deploy
+    a stack to multiple regions concurrently, one thread per region.
+
+    Example:
+        with aws_region("eu-west-1"):
+            AWS().client.describe_stacks()
+    """
+    previous = get_aws_region()
+    _aws_region.name = region
+    try:
+        yield
+    finally:
+        _aws_region.name = previous
+
+
+class AWSClients(Singleton):
+    """ A thread safe pool of boto3 clients and resources
+
+    Creating a client loads botocore's service model, which is slow and uses
+    a lot of memory, so clients are created once per service, region and
+    profile, and shared by all threads (boto3 clients are thread safe).
+    Roles are assumed by using a profile with a role_arn, so botocore
+    refreshes the credentials when needed.
+
+    Throttled and failed calls are retried with botocore's standard
+    retry mode, GPWM_HTTP_RETRIES (default 3) times.
+
+    The stats counter tells how many clients were created and reused.
+    """
+    __CLIENTS__ = {}
+    __SESSIONS__ = {}
+    _lock = threading.Lock()
+    stats = collections.Counter()
+
+    def get_session(self, profile=None):
+        """ Returns the boto3 session of a profile (None for the default)
+        """
+        with self._lock:
+            if profile not in self.__SESSIONS__:
+                import boto3
+                self.__SESSIONS__[profile] = boto3.session.Session(
+                    profile_name=profile
+                )
+            return self.__SESSIONS__[profile]
+
+    def get(self, service, region=None, profile=None, kind="client"):
+        """ Returns a boto3 client
+
+        Args:
+            service(str): The service name, for example "cloudformation"
+            region(str): The region. Defaults to the region of the current
+                thread (see aws_region()), or the profile's region
+            profile(str): The AWS CLI profile. Defaults to the environment
+            kind(str): "client" or "resource"
+        """
+        region = region or get_aws_region()
+        key = (kind, service, region, profile)
+        client = self.__CLIENTS__.get(key)
+        if client is not None:
+            self.stats[f"{kind}s_reused"] += 1
+            return client
+
+        session = self.get_session(profile)
+        with self._lock:
+            if key not in self.__CLIENTS__:
+                import botocore.config
+                config = botocore.config.Config(retries={
+                    "mode": "standard",
+                    "max_attempts": int(
+                        os.environ.get("GPWM_HTTP_RETRIES", "3")
+                    ) + 1
+                })
+                create = getattr(session, kind)
+                self.__CLIENTS__[key] = create(
+                    service,
+                    region_name=region,
+                    config=config
+                )
+                self.stats[f"{kind}s_created"] += 1
+            else:
+                self.stats[f"{kind}s_reused"] += 1
+            return self.__CLIENTS__[key]
+
+    def clear(self):
+        """ Forgets all the clients and sessions
+        """
+        with self._lock:
+            self.__CLIENTS__.clear()
+            self.__SESSIONS__.clear()
+            self.stats.clear()
+
+
 class AWS(Singleton):
     """ Class representing an AWS CFN Boto client and resources """
 
     @property
     def client(self):
-        if not hasattr(self, "_client"):
-            self._client = boto3.client("cloudformation")
-        return self._client
+        return AWSClients().get("cloudformation")
 
     @property
     def resource(self):
-        if not hasattr(self, "_resource"):
-            self._resource = boto3.resource("cloudformation")
-        return self._resource
+        return AWSClients().get("cloudformation", kind="resource")
 
 
 def get_azure_api_client(cls, **kwargs):
@@ -73,6 +180,8 @@ def get_azure_api_client(cls, **kwargs):
 
     https://github.com/Azure/azure-sdk-for-python/blob/master/azure-common/azure/common/client_factory.py # noqa
     """
+    from azure.common.client_factory import get_client_from_auth_file
+    from azure.common.client_factory import get_client_from_cli_profile
 
     if os.environ.get("AZURE_AUTH_LOCATION"):
         return get_client_from_auth_file(cls, **kwargs)
@@ -80,9 +189,21 @@ def get_azure_api_client(cls, **kwargs):
 
 
 class AzureClient(Singleton):
-    """ Class for retrieving Azure API clients """
+    """ Class for retrieving Azure API clients
+
+    Clients are cached by client class, credentials and subscription,
+    service principal credentials (which fetch a token when built) are
+    built once per principal, and subscription names are resolved to UUIDs
+    only once. Setting the GPWM_AZURE_SUBSCRIPTION_CACHE_TTL env variable
+    (in seconds) also caches the subscription names on disk, in the
+    "azure" cache. The network calls are made under per-key locks, so
+    lookups of different clients don't wait for each other.
+    """
 
     __CACHE__ = {}
+    __CREDENTIALS__ = {}
+    __SUBSCRIPTIONS__ = {}
+    _locks = collections.defaultdict(threading.Lock)
 
     def get(self, client, client_id=None, secret=None, tenant=None,
             subscription=None):
@@ -98,7 +219,7 @@ class AzureClient(Singleton):
                 * AZURE_SUBSCRIPTION: Either an UUID or the subscription
                     name. If the subscription name is supplied, the UUID
                     is obtained by making a *SubscriptionClient.list()*
-                    API call.
+                    API call (see get_subscription_id()).
             3- The AZURE_AUTH_LOCATION environment variable which
                specifies a path to the service principal auth file. The
                auth. Can be obtained, for example by creating a new
@@ -135,47 +256,144 @@ class AzureClient(Singleton):
         tenant = tenant or os.environ.get("AZURE_TENANT_ID")
         subscription = subscription or \
             os.environ.get("AZURE_SUBSCRIPTION")
-
-        # Get the api client class
-        full_path = f"azure.mgmt.{client}".split(".")
-        class_name = full_path[-1]
-        module = ".".join(full_path[:-1])
-        cls = getattr(importlib.import_module(module), class_name)
-
-        kwargs = {}
+        # identifies the credentials, without keeping the secret around
+        credentials_key = (
+            client_id,
+            tenant,
+            gpwm.caches.content_hash(secret) if secret else None,
+            os.environ.get("AZURE_AUTH_LOCATION")
+        )
+
+        # Credentials passed via this method or environment variables are
+        # only needed (and built) on cache misses
+        def get_credentials():
+            if client_id and secret and tenant:
+                return self.get_credentials(credentials_key, client_id,
+                                            secret, tenant)
+            return None
 
         # Find the subscription id
+        subscription_id = None
         if subscription:
-            # resolve UUID of the subscription (if passed as name)
-            try:
-                subscription_id = str(uuid.UUID(subscription, version=4))
-            except ValueError as exc:
-                subscription_client = get_azure_api_client(SubscriptionClient)
-                for s in subscription_client.subscriptions.list():
-                    print(s.__dict__)
-                    if s.display_name == subscription:
-                        subscription_id = s.subscription_id
-                        break
-                else:
-                    raise SystemExit(f"Subscription {subscription} not found")
-            kwargs["subscription_id"] = subscription_id
-
-        # Get a credentials object if creds passed via this method or
-        # environment variables
-        if client and secret and tenant:
-            kwargs["credentials"] = ServicePrincipalCredentials(
-                client_id=client_id,
-                secret=secret,
-                tenant=tenant
+            subscription_id = self.get_subscription_id(
+                subscription,
+                credentials_key,
+                get_credentials
             )
 
-        return get_azure_api_client(cls, **kwargs)
+        key = (client, credentials_key, subscription_id)
+        if key in self.__CACHE__:
+            return self.__CACHE__[key]
+        with self._locks[key]:
+            if key not in self.__CACHE__:
+                kwargs = {}
+                credentials = get_credentials()
+                if credentials:
+                    kwargs["credentials"] = credentials
+                if subscription_id:
+                    kwargs["subscription_id"] = subscription_id
+                # Get the api client class
+                full_path = f"azure.mgmt.{client}".split(".")
+                class_name = full_path[-1]
+                module = ".".join(full_path[:-1])
+                cls = getattr(importlib.import_module(module), class_name)
+                self.__CACHE__[key] = get_azure_api_client(cls, **kwargs)
+        return self.__CACHE__[key]
+
+    def get_credentials(self, credentials_key, client_id, secret, tenant):
+        """ Returns service principal credentials, built once per principal
+
+        Building the credentials fetches a token from Azure AD.
+
+        Args:
+            credentials_key(tuple): Identifies the credentials
+            client_id(str): UUID representing the user
+            secret(str): Secret used for user auth
+            tenant(str): UUID representing the Azure tenant
+        """
+        if credentials_key in self.__CREDENTIALS__:
+            return self.__CREDENTIALS__[credentials_key]
+        with self._locks[("credentials", credentials_key)]:
+            if credentials_key not in self.__CREDENTIALS__:
+                from azure.common.credentials import \
+                    ServicePrincipalCredentials
+                self.__CREDENTIALS__[credentials_key] = \
+                    ServicePrincipalCredentials(
+                        client_id=client_id,
+                        secret=secret,
+                        tenant=tenant
+                    )
+        return self.__CREDENTIALS__[credentials_key]
+
+    def get_subscription_id(self, subscription, credentials_key,
+                            get_credentials=None):
+        """ Returns the UUID of a subscription
+
+        Args:
+            subscription(str): The subscription UUID or name
+            credentials_key(tuple): Identifies the credentials used
+            get_credentials(callable): Returns the credentials object, if
+                any. Only called if the subscriptions must be listed.
+
+        All the subscriptions visible with the credentials are listed at
+        once, so the names of other subscriptions don't need another call.
+        """
+        try:
+            return str(uuid.UUID(subscription, version=4))
+        except ValueError:
+            pass
+
+        key = (credentials_key, subscription)
+        if key in self.__SUBSCRIPTIONS__:
+            return self.__SUBSCRIPTIONS__[key]
+        # the subscriptions are listed once, even by concurrent lookups
+        with self._locks[("subscriptions", credentials_key)]:
+            if key in self.__SUBSCRIPTIONS__:
+                return self.__SUBSCRIPTIONS__[key]
+
+            ttl = os.environ.get("GPWM_AZURE_SUBSCRIPTION_CACHE_TTL")
+            cache = gpwm.caches.JsonCache("azure", "subscriptions")
+            disk_key = repr(key)
+            if ttl:
+                subscription_id = cache.get(disk_key, ttl=float(ttl))
+                if subscription_id:
+                    self.__SUBSCRIPTIONS__[key] = subscription_id
+                    return subscription_id
+
+            from azure.mgmt.resource import SubscriptionClient
+            credentials = get_credentials() if get_credentials else None
+            kwargs = {"credentials": credentials} if credentials else {}
+            subscription_client = get_azure_api_client(
+                SubscriptionClient,
+                **kwargs
+            )
+            for s in subscription_client.subscriptions.list():
+                self.__SUBSCRIPTIONS__[(credentials_key, s.display_name)] = \
+                    s.subscription_id
+                if ttl:
+                    cache.set(
+                        repr((credentials_key, s.display_name)),
+                        s.subscription_id
+                    )
+            if key not in self.__SUBSCRIPTIONS__:
+                raise SystemExit(f"Subscription {subscription} not found")
+            return self.__SUBSCRIPTIONS__[key]
 
 
 class GCP(Singleton):
-    """ Class representing a GCP Deployment Manager API client """
+    """ Class representing a GCP Deployment Manager API client
+
+    The Google API client isn't thread safe (httplib2), so each thread gets
+    its own client.
+    """
+    _local = threading.local()
+
     @property
     def client(self):
-        if not hasattr(self, "_client"):
-            self._client = apiclient.discovery.build("deploymentmanager", "v2")
-        return self._client
+        if not hasattr(self._local, "client"):
+            import apiclient.discovery  # GCP API
+            self._local.client = apiclient.discovery.build(
+                "deploymentmanager",
+                "v2"
+            )
+        return self._local.client
@@ -12,6 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
+import gpwm.caches
+import gpwm.utils
+
+
+# The tag/label holding the fingerprint of the last deployment
+FINGERPRINT_KEY = "gpwm_fingerprint"
+# The keys of a stack file that can define the stack type
+STACK_TYPE_KEYS = ["StackType", "stack_type", "Type", "type"]
+
+
+def get_fingerprint(*parts):
+    """ Returns a deterministic hash of everything that defines a deployment
+
+    The parts (rendered template, parameters, tags...) are serialized as
+    JSON with sorted keys, so the hash only changes when the content does.
+    The build ID changes on every run and must not be part of it.
+
+    The hash is 40 characters long, short enough for GCP labels.
+    """
+    content = gpwm.utils.dump_json(parts, sort_keys=True)
+    return gpwm.caches.content_hash(content)[:40]
+
+
+def force_update():
+    """ Returns True if no-op updates must not be skipped
+
+    Set the GPWM_FORCE_UPDATE env variable to always update stacks, even if
+    their fingerprint didn't change.
+    """
+    return bool(os.environ.get("GPWM_FORCE_UPDATE"))
+
 
 class BaseStack(object):
     """ Base class for different types of stacks.
@@ -19,34 +52,71 @@ class BaseStack(object):
     def __init__(self, **kwargs):
         [setattr(self, k, v) for k, v in kwargs.items()]
 
+    def get_artifact(self):
+        """ Returns the attributes of the fully rendered stack
 
-def factory(**kwargs):
-    """ Factory for different types of stacks
+        The result is what from_artifact() needs to rebuild the stack
+        without rendering templates or resolving YAML tags. Private
+        attributes are left out.
+        """
+        return {
+            k: v for k, v in self.__dict__.items() if not k.startswith("_")
+        }
 
-    Imports are being done here so SDKs for multiple providers don't need to
-    be installed if never used.
+    @classmethod
+    def from_artifact(cls, attributes):
+        """ Rebuilds a stack from the output of get_artifact()
+
+        The constructor isn't called, as the attributes were already
+        processed by it.
+        """
+        stack = cls.__new__(cls)
+        stack.__dict__.update(attributes)
+        return stack
+
+
+def get_stack_type(stack_attributes):
+    """ Returns the type of a stack, in lower case
+
+    Args:
+        stack_attributes(dict): The attributes of the stack, as in the
+            stack file
+
+    The type is the value of the first of STACK_TYPE_KEYS found in the
+    stack attributes. Defaults to "cloudformation".
     """
+    for key in STACK_TYPE_KEYS:
+        if key in stack_attributes:
+            return stack_attributes[key].lower()
+    return "cloudformation"
 
-    # default type is Cloudformation
-    possible_stack_type_keys = ["StackType", "stack_type", "Type", "type"]
-    stack_keys = kwargs.keys()
-    for possible_stack_type in possible_stack_type_keys:
-        if possible_stack_type in stack_keys:
-            stack_type = kwargs.pop(possible_stack_type).lower()
-            break
-    else:
-        stack_type = "cloudformation"
 
+def get_stack_class(stack_type):
+    """ Returns the class implementing a type of stack
+
+    Imports are being done here so SDKs for multiple providers don't need to
+    be installed if never used.
+    """
     if stack_type == "cloudformation":
         import gpwm.stacks.aws
-        return gpwm.stacks.aws.CloudformationStack(**kwargs)
+        return gpwm.stacks.aws.CloudformationStack
     elif stack_type == "azure":
         import gpwm.stacks.azure
-        return gpwm.stacks.azure.AzureStack(**kwargs)
+        return gpwm.stacks.azure.AzureStack
     elif stack_type == "shell":
         import gpwm.stacks.shell
-        return gpwm.stacks.shell.ShellStack(**kwargs)
+        return gpwm.stacks.shell.ShellStack
     elif stack_type == "gcp":
         import gpwm.stacks.gcp
-        return gpwm.stacks.gcp.GCPStack(**kwargs)
+        return gpwm.stacks.gcp.GCPStack
     raise SystemExit("Stack type not supported: {}".format(stack_type))
+
+
+def factory(**kwargs):
+    """ Factory for different types of stacks
+    """
+
+    stack_type = get_stack_type(kwargs)
+    for key in STACK_TYPE_KEYS:
+        kwargs.pop(key, None)
+    return get_stack_class(stack_type)(**kwargs)
@@ -14,14 +14,159 @@
 
 from __future__ import print_function
 from six.moves import input
+import os
 import time
-import yaml
 
 from botocore.exceptions import ClientError
 
+import gpwm.caches
 import gpwm.renderers
 from gpwm.sessions import AWS as AWSSession
+from gpwm.sessions import AWSClients
+from gpwm.sessions import get_aws_region
 import gpwm.stacks
+import gpwm.utils
+
+
+# Cloudformation's limit for templates passed inline as TemplateBody
+TEMPLATE_BODY_MAX_SIZE = 51200
+# Statuses in which a stack's tags describe what is deployed
+STABLE_STACK_STATUSES = [
+    "CREATE_COMPLETE",
+    "UPDATE_COMPLETE",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "IMPORT_COMPLETE"
+]
+# The stack statuses ending an action, and the one meaning success
+COMPLETE_STACK_STATUSES = {
+    "create": "CREATE_COMPLETE",
+    "update": "UPDATE_COMPLETE",
+    "delete": "DELETE_COMPLETE"
+}
+TERMINAL_STACK_STATUSES = list(COMPLETE_STACK_STATUSES.values()) + [
+    "CREATE_FAILED",
+    "ROLLBACK_COMPLETE",
+    "ROLLBACK_FAILED",
+    "DELETE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "UPDATE_ROLLBACK_FAILED"
+]
+# Stack events are polled every WAIT_MIN_INTERVAL seconds at first, slowing
+# down by WAIT_BACKOFF while nothing happens, up to WAIT_MAX_INTERVAL
+WAIT_MIN_INTERVAL = 1
+WAIT_MAX_INTERVAL = 15
+WAIT_BACKOFF = 1.5
+# What to do with a change set once it's created, see manage_change_set()
+CHANGE_SET_POLICIES = [
+    "prompt",
+    "execute",
+    "keep",
+    "delete",
+    "execute-unless-replacement"
+]
+# Reasons given by Cloudformation for failed change sets without changes
+NO_CHANGES_REASONS = [
+    "The submitted information didn't contain changes",
+    "No updates are to be performed"
+]
+# The regions of the buckets templates are uploaded to, by bucket name
+BUCKET_REGIONS = {}
+
+
+def get_bucket_region(bucket):
+    """ Returns the region of an S3 bucket, looked up once per run
+    """
+    if bucket not in BUCKET_REGIONS:
+        location = gpwm.renderers.get_s3_client().get_bucket_location(
+            Bucket=bucket
+        ).get("LocationConstraint")
+        # buckets in us-east-1 have no location constraint, and the oldest
+        # buckets in eu-west-1 have "EU"
+        BUCKET_REGIONS[bucket] = {None: "us-east-1", "EU": "eu-west-1"}.get(
+            location or None,
+            location
+        )
+    return BUCKET_REGIONS[bucket]
+
+
+def upload_template(template_body, extension="yaml"):
+    """ Uploads a template to S3 under a key derived from its content
+
+    The bucket (and optional prefix) is set by the GPWM_TEMPLATE_BUCKET env
+    variable, for example "my-bucket/cloudformation". The upload is skipped
+    if the object already exists, so deploying the same template again
+    costs a single HEAD request. The template is uploaded to, and its URL
+    built from, the S3 endpoint of the bucket's region, so stacks in any
+    region can share the bucket.
+
+    Args:
+        template_body(str): The serialized template
+        extension(str): The extension of the S3 key ("yaml" or "json")
+
+    Returns: The URL of the template, to be used as TemplateURL
+    """
+    location = os.environ.get("GPWM_TEMPLATE_BUCKET")
+    if not location:
+        raise SystemExit(
+            f"Template is larger than {TEMPLATE_BODY_MAX_SIZE} bytes. "
+            "Set GPWM_TEMPLATE_BUCKET to upload it to S3"
+        )
+    bucket, _, prefix = location.partition("/")
+    key = f"{gpwm.caches.content_hash(template_body)}.{extension}"
+    if prefix.strip("/"):
+        key = f"{prefix.strip('/')}/{key}"
+
+    s3 = AWSClients().get("s3", region=get_bucket_region(bucket))
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+            raise
+        s3.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=template_body.encode("utf-8")
+        )
+    return f"{s3.meta.endpoint_url}/{bucket}/{key}"
+
+
+def get_stack_events(stack_name, last_event_id=None):
+    """ Returns the events of a stack newer than last_event_id
+
+    describe_stack_events returns the newest events first, so pages are only
+    read until last_event_id is found.
+
+    Args:
+        stack_name(str): The name or ID of the stack
+        last_event_id(str): The ID of the last event already seen. If None,
+            all events are returned.
+
+    Returns: A list of events, oldest first
+    """
+    events = []
+    kwargs = {"StackName": stack_name}
+    while True:
+        response = AWSSession().client.describe_stack_events(**kwargs)
+        for event in response["StackEvents"]:
+            if event["EventId"] == last_event_id:
+                return events[::-1]
+            events.append(event)
+        if not response.get("NextToken"):
+            return events[::-1]
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def format_stack_event(event):
+    """ Returns a stack event as a single line of progress
+    """
+    line = (
+        f"{event['Timestamp']:%H:%M:%S} {event['StackName']} "
+        f"{event['ResourceStatus']} {event['ResourceType']} "
+        f"{event['LogicalResourceId']}"
+    )
+    if event.get("ResourceStatusReason"):
+        line += f": {event['ResourceStatusReason']}"
+    return line
 
 
 class CloudformationStack(gpwm.stacks.BaseStack):
@@ -39,9 +184,9 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         """
         super(CloudformationStack, self).__init__(**kwargs)
 
-        if isinstance(self.TemplateBody, dict):
-            self.TemplateBody = yaml.dump(self.TemplateBody, indent=2)
-        else:
+        # The template is kept loaded and only serialized once, when the
+        # first API call is made. See get_template_body()
+        if not isinstance(self.TemplateBody, dict):
             parsed_url, template_body = \
                 gpwm.renderers.get_template_body(self.TemplateBody)
 
@@ -69,7 +214,7 @@ class CloudformationStack(gpwm.stacks.BaseStack):
             else:
                 raise SystemExit("file extension not supported")
 
-            self.TemplateBody = yaml.dump(template, indent=2)
+            self.TemplateBody = template
 
         # make sure "Tags" is a list of dicts. Making a shallow copy
         # just in case
@@ -82,38 +227,257 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         # cleanup non-cfn attributes
         del self.BuildId
 
+    def get_template_body(self):
+        """ Returns the template serialized for the Cloudformation API
+
+        The template is serialized as YAML, or as compact JSON if the
+        GPWM_TEMPLATE_FORMAT env variable is set to "json". JSON is much
+        faster to produce and smaller on the wire. The result is memoized,
+        so the template is serialized only once no matter how many API
+        calls are made.
+        """
+        template_format = os.environ.get("GPWM_TEMPLATE_FORMAT", "yaml")
+        if template_format not in ["yaml", "json"]:
+            raise SystemExit(
+                f"Invalid GPWM_TEMPLATE_FORMAT: {template_format}"
+            )
+        if getattr(self, "_template_format", None) != template_format:
+            if template_format == "json":
+                body = gpwm.utils.dump_json(self.TemplateBody)
+            else:
+                body = gpwm.utils.dump_yaml(self.TemplateBody, indent=2)
+            self._template_body = body
+            self._template_format = template_format
+        return self._template_body
+
+    def get_template_args(self):
+        """ Returns the template argument for the Cloudformation API
+
+        Templates larger than TEMPLATE_BODY_MAX_SIZE are uploaded to S3 by
+        upload_template() and passed as TemplateURL, smaller ones are
+        passed inline as TemplateBody.
+
+        Returns: A dict with either TemplateBody or TemplateURL
+        """
+        template_body = self.get_template_body()
+        if len(template_body.encode("utf-8")) <= TEMPLATE_BODY_MAX_SIZE:
+            return {"TemplateBody": template_body}
+        if getattr(self, "_template_url_body", None) is not template_body:
+            self._template_url = upload_template(
+                template_body,
+                self._template_format
+            )
+            self._template_url_body = template_body
+        return {"TemplateURL": self._template_url}
+
+    def get_fingerprint(self):
+        """ Returns the fingerprint of the stack
+
+        See gpwm.stacks.get_fingerprint(). The build_id tag is left out.
+        The template is fingerprinted as loaded, not as serialized, so the
+        fingerprint doesn't depend on GPWM_TEMPLATE_FORMAT, nor on whether
+        the stack was loaded from a stack file or from an artifact.
+        """
+        api_args = {
+            k: v for k, v in self.__dict__.items()
+            if not k.startswith("_") and k not in ["TemplateBody", "Tags"]
+        }
+        tags = [t for t in self.Tags if t["Key"] != "build_id"]
+        return gpwm.stacks.get_fingerprint(
+            self.TemplateBody,
+            api_args,
+            tags
+        )
+
+    def get_api_args(self):
+        """ Returns the attributes of the stack as Cloudformation API args
+
+        The template is serialized by get_template_args(), the fingerprint
+        of the stack is added to the tags, and the private attributes are
+        left out.
+        """
+        api_args = {
+            k: v for k, v in self.__dict__.items()
+            if not k.startswith("_") and k != "TemplateBody"
+        }
+        api_args.update(self.get_template_args())
+        api_args["Tags"] = self.Tags + [{
+            "Key": gpwm.stacks.FINGERPRINT_KEY,
+            "Value": self.get_fingerprint()
+        }]
+        return api_args
+
+    def is_up_to_date(self):
+        """ Returns True if the deployed stack has the same fingerprint
+
+        Raises ClientError if the stack doesn't exist.
+        """
+        if gpwm.stacks.force_update():
+            return False
+        stack = AWSSession().client.describe_stacks(
+            StackName=self.StackName
+        )["Stacks"][0]
+        if stack["StackStatus"] not in STABLE_STACK_STATUSES:
+            return False
+        tags = {t["Key"]: t["Value"] for t in stack.get("Tags", [])}
+        return tags.get(gpwm.stacks.FINGERPRINT_KEY) == self.get_fingerprint()
+
+    def get_last_event_id(self):
+        """ Returns the ID of the newest event of the stack, if any
+        """
+        try:
+            events = AWSSession().client.describe_stack_events(
+                StackName=self.StackName
+            )["StackEvents"]
+        except ClientError:
+            return None
+        return events[0]["EventId"] if events else None
+
+    def wait(self, action, last_event_id=None, timeout=None):
+        """ Waits for an action to complete, streaming the stack events
+
+        Unlike botocore's waiters, which poll every 30 seconds, the events
+        are polled every WAIT_MIN_INTERVAL seconds at first, backing off to
+        WAIT_MAX_INTERVAL while nothing happens. Every new event is printed,
+        and the wait ends as soon as the stack reaches a terminal status.
+
+        Args:
+            action(str): create, update or delete
+            last_event_id(str): The newest event before the action started.
+                Older events are ignored.
+            timeout(int): The total wait timeout in seconds. Defaults to the
+                GPWM_WAIT_TIMEOUT env variable or 3600
+        """
+        if timeout is None:
+            timeout = float(os.environ.get("GPWM_WAIT_TIMEOUT", "3600"))
+        interval = WAIT_MIN_INTERVAL
+        deadline = time.monotonic() + timeout
+        failure = None
+        # events of concurrent deployments to other regions are interleaved
+        region = get_aws_region()
+        prefix = f"[{region}] " if region else ""
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            try:
+                events = get_stack_events(self.StackName, last_event_id)
+            except ClientError as exc:
+                message = exc.response["Error"]["Message"]
+                if action == "delete" and "does not exist" in message:
+                    return
+                raise
+            interval = WAIT_MIN_INTERVAL if events else \
+                min(interval * WAIT_BACKOFF, WAIT_MAX_INTERVAL)
+
+            for event in events:
+                last_event_id = event["EventId"]
+                print(prefix + format_stack_event(event))
+                status = event["ResourceStatus"]
+                if status.endswith("_FAILED") and not failure:
+                    failure = event.get("ResourceStatusReason", status)
+                if event["ResourceType"] != "AWS::CloudFormation::Stack" or \
+                        event["LogicalResourceId"] != self.StackName or \
+                        status not in TERMINAL_STACK_STATUSES:
+                    continue
+                if status == COMPLETE_STACK_STATUSES[action]:
+                    return
+                raise SystemExit(
+                    f"Stack {self.StackName} {status}: {failure or ''}"
+                )
+        raise SystemExit(
+            f"Timed out waiting for stack {self.StackName} to {action}"
+        )
+
     def create(self, wait=False):
         self.validate()
-        AWSSession().resource.create_stack(**self.__dict__)
+        AWSSession().resource.create_stack(**self.get_api_args())
         if wait:
-            waiter = AWSSession().client.get_waiter(
-                "stack_create_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+            self.wait("create")
 
     def delete(self, wait=False):
+        last_event_id = self.get_last_event_id() if wait else None
         cf_stack = AWSSession().resource.Stack(self.StackName)
         cf_stack.delete()
         if wait:
-            waiter = AWSSession().client.get_waiter(
-                "stack_delete_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+            self.wait("delete", last_event_id)
 
     def update(self, wait=False, review=True):
+        if self.is_up_to_date():
+            print(f"===> {self.StackName} is up to date, skipping update")
+            return
         self.validate()
         if review:
-            self.manage_change_set()
-        else:
-            cf_stack = AWSSession().resource.Stack(self.StackName)
-            cf_stack.update(**self.__dict__)
+            self.manage_change_set(wait=wait)
+            return
+        last_event_id = self.get_last_event_id() if wait else None
+        cf_stack = AWSSession().resource.Stack(self.StackName)
+        cf_stack.update(**self.get_api_args())
         if wait:
-            waiter = AWSSession().client.get_waiter(
-                "stack_update_complete"
+            self.wait("update", last_event_id)
+
+    def describe_change_set(self, change_set_name, timeout=None):
+        """ Waits for a change set to be created and returns it
+
+        The change set is polled with the same adaptive interval as the
+        stack events in wait(). All pages of changes are read.
+
+        Args:
+            change_set_name(str): The name of the change set
+            timeout(int): The total wait timeout in seconds. Defaults to the
+                GPWM_WAIT_TIMEOUT env variable or 3600
+
+        Returns: The change set, or None if it didn't contain changes
+        """
+        if timeout is None:
+            timeout = float(os.environ.get("GPWM_WAIT_TIMEOUT", "3600"))
+        deadline = time.monotonic() + timeout
+        interval = WAIT_MIN_INTERVAL
+        kwargs = {
+            "ChangeSetName": change_set_name,
+            "StackName": self.StackName
+        }
+        while True:
+            change_set = AWSSession().client.describe_change_set(**kwargs)
+            if change_set["Status"] not in ["CREATE_PENDING",
+                                            "CREATE_IN_PROGRESS"]:
+                break
+            if time.monotonic() > deadline:
+                raise SystemExit(
+                    f"Timed out waiting for change set {change_set_name}"
+                )
+            time.sleep(interval)
+            interval = min(interval * WAIT_BACKOFF, WAIT_MAX_INTERVAL)
+
+        if change_set["Status"] == "FAILED":
+            reason = change_set.get("StatusReason", "")
+            if any(r in reason for r in NO_CHANGES_REASONS):
+                return None
+            raise SystemExit(
+                f"Change set {change_set_name} failed: {reason}"
+            )
+
+        while change_set.get("NextToken"):
+            page = AWSSession().client.describe_change_set(
+                NextToken=change_set.pop("NextToken"),
+                **kwargs
             )
-            waiter.wait(StackName=self.StackName)
+            change_set["Changes"].extend(page["Changes"])
+            change_set["NextToken"] = page.get("NextToken")
+        change_set.pop("NextToken", None)
+        change_set.pop("ResponseMetadata", None)
+        return change_set
 
     def manage_change_set(self, wait=False):
+        """ Creates a change set and executes, keeps or deletes it
+
+        What happens to the change set is decided by the
+        GPWM_CHANGE_SET_POLICY env variable (see get_change_set_answer()),
+        and defaults to asking the user. Change sets without changes are
+        always deleted.
+        """
+        policy = os.environ.get("GPWM_CHANGE_SET_POLICY", "prompt")
+        if policy not in CHANGE_SET_POLICIES:
+            raise SystemExit(f"Invalid GPWM_CHANGE_SET_POLICY: {policy}")
+
         # find build ID in tags
         for tag in self.Tags:
             if tag["Key"] == "build_id":
@@ -123,37 +487,70 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         AWSSession().client.create_change_set(
             ChangeSetName=change_set_name,
             ChangeSetType="UPDATE",
-            **self.__dict__
+            **self.get_api_args()
         )
 
-        # wait for change set to be ready
-        time.sleep(2)
-        waiter = AWSSession().client.get_waiter(
-            "change_set_create_complete"
-        )
-        waiter.wait(ChangeSetName=change_set_name, StackName=self.StackName)
+        change_set = self.describe_change_set(change_set_name)
+        if change_set is None:
+            print(f"Changeset {change_set_name} has no changes. Deleting it")
+            self.execute_change_set_answer(change_set_name, "d")
+            return
 
-        change_set = AWSSession().client.describe_change_set(
-            ChangeSetName=change_set_name,
-            StackName=self.StackName
-        )
-        change_set.pop("ResponseMetadata")
         print("---------- Change Set ----------")
-        print(yaml.dump(change_set, indent=2))
+        print(gpwm.utils.dump_yaml(change_set, indent=2))
         print("--------------------------------")
 
-        answer = False
-        while not answer:
-            answer = self.changeset_user_input(change_set_name)
-
-        if wait:
-            waiter = AWSSession().client.get_waiter(
-                "stack_update_complete"
+        last_event_id = self.get_last_event_id() if wait else None
+        if policy == "prompt":
+            answer = False
+            while not answer:
+                answer = self.changeset_user_input(change_set_name)
+        else:
+            answer = self.execute_change_set_answer(
+                change_set_name,
+                self.get_change_set_answer(policy, change_set)
             )
-            waiter.wait(StackName=self.StackName)
+
+        if wait and answer == "e":
+            self.wait("update", last_event_id)
+
+    def get_change_set_answer(self, policy, change_set):
+        """ Returns the answer to a change set given by a policy
+
+        Args:
+            policy(str): One of:
+                - execute: executes the change set
+                - keep: keeps the change set for later review
+                - delete: deletes the change set
+                - execute-unless-replacement: executes the change set,
+                  unless a resource would (or might) be replaced, in which
+                  case it's kept for review
+            change_set(dict): The output of describe_change_set()
+
+        Returns: "e", "k" or "d", like changeset_user_input()
+        """
+        if policy == "execute-unless-replacement":
+            replacements = [
+                c["ResourceChange"]["LogicalResourceId"]
+                for c in change_set.get("Changes", [])
+                if c.get("ResourceChange", {}).get("Replacement") in [
+                    "True",
+                    "Conditional"
+                ]
+            ]
+            if replacements:
+                print(
+                    f"Resources would be replaced: {', '.join(replacements)}"
+                )
+                return "k"
+            return "e"
+        return {"execute": "e", "keep": "k", "delete": "d"}[policy]
 
     def changeset_user_input(self, change_set_name):
         answer = input("Execute(e), Delete (d), or Keep(k) change set? ")
+        return self.execute_change_set_answer(change_set_name, answer)
+
+    def execute_change_set_answer(self, change_set_name, answer):
         if answer == "e":
             print("Executing changeset {}...".format(change_set_name))
             AWSSession().client.execute_change_set(
@@ -171,10 +568,11 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         else:
             print("Valid answers: e, d, k")
             return False
-        return True
+        return answer
 
     def upsert(self, wait=False):
-        self.validate()
+        # update() and create() validate the template themselves, and
+        # no-op updates don't need validating at all
         try:
             self.update(wait=wait)
         except ClientError as exc:
@@ -184,15 +582,28 @@ class CloudformationStack(gpwm.stacks.BaseStack):
                 raise
 
     def render(self):
-        # un-stringfy the TemplateBody so it displays nicely on screen
-        template = self.__dict__.copy()
-        template["TemplateBody"] = yaml.load(template["TemplateBody"])
-        print(yaml.dump(template, indent=2))
+        template = {
+            k: v for k, v in self.__dict__.items() if not k.startswith("_")
+        }
+        print(gpwm.utils.dump_yaml(template, indent=2))
 
     def validate(self):
+        """ Validates the template with Cloudformation
+
+        Successful validations are cached in the "validations" cache, per
+        region and template content, so unchanged templates are only
+        validated once.
+        """
+        client = AWSSession().client
+        cache = gpwm.caches.JsonCache("validations", "cloudformation")
+        key = gpwm.caches.content_hash(
+            client.meta.region_name,
+            self.get_template_body()
+        )
+        if cache.get(key):
+            return
         try:
-            AWSSession().client.validate_template(
-                TemplateBody=self.TemplateBody
-            )
+            client.validate_template(**self.get_template_args())
         except ClientError as exc:
             raise SystemExit(exc.response["Error"]["Message"])
+        cache.set(key, True)
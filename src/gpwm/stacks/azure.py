@@ -15,6 +15,7 @@
 import json
 
 from azure.mgmt.resource.resources.models import ParametersLink
+from msrestazure.azure_exceptions import CloudError
 from azure.mgmt.resource.resources.models import TemplateLink
 
 import gpwm.renderers
@@ -112,6 +113,79 @@ class AzureStack(gpwm.stacks.BaseStack):
             "resource.ResourceManagementClient"
         )
 
+    def get_artifact(self):
+        """ Returns the attributes of the fully rendered deployment
+
+        Links are represented by their URIs, and the API client is left
+        out.
+        """
+        attributes = super().get_artifact()
+        del attributes["api_client"]
+        for link in ["templateLink", "parametersLink"]:
+            if link in attributes:
+                attributes[link] = attributes[link].uri
+        return attributes
+
+    @classmethod
+    def from_artifact(cls, attributes):
+        stack = super().from_artifact(attributes)
+        if hasattr(stack, "templateLink"):
+            stack.templateLink = TemplateLink(stack.templateLink)
+        if hasattr(stack, "parametersLink"):
+            stack.parametersLink = ParametersLink(stack.parametersLink)
+        stack.api_client = AzureClient().get(
+            "resource.ResourceManagementClient"
+        )
+        return stack
+
+    @property
+    def fingerprint(self):
+        """ The fingerprint of the deployment and its resource group
+
+        See gpwm.stacks.get_fingerprint(). Links are represented by their
+        URIs.
+        """
+        properties = self.deploymentProperties
+        for link in ["templateLink", "parametersLink"]:
+            if link in properties:
+                properties[link] = properties[link].uri
+        return gpwm.stacks.get_fingerprint(
+            properties,
+            self.resourceGroupParameters
+        )
+
+    @property
+    def fingerprintTag(self):
+        """ The resource group tag holding the deployment's fingerprint
+
+        Deployments have no tags, and a resource group can have several
+        deployments, so the tag name includes the deployment name.
+        """
+        return f"{gpwm.stacks.FINGERPRINT_KEY}_{self.name}"
+
+    def is_up_to_date(self):
+        """ Returns True if the deployment has the same fingerprint
+
+        The fingerprint is only trusted if the deployment succeeded.
+        """
+        if gpwm.stacks.force_update():
+            return False
+        try:
+            resource_group = self.api_client.resource_groups.get(
+                self.resourceGroup["name"]
+            )
+            deployment = self.api_client.deployments.get(
+                resource_group_name=self.resourceGroup["name"],
+                deployment_name=self.name
+            )
+        except CloudError:
+            return False
+        tags = resource_group.tags or {}
+        return (
+            deployment.properties.provisioning_state == "Succeeded" and
+            tags.get(self.fingerprintTag) == self.fingerprint
+        )
+
     @property
     def resourceGroupParameters(self):
         return {
@@ -134,12 +208,23 @@ class AzureStack(gpwm.stacks.BaseStack):
         }
 
     def upsert(self, wait=False):
-        self.create_resource_group()
+        if self.is_up_to_date():
+            print(f"===> {self.name} is up to date, skipping update")
+            return
+        resource_group = self.create_resource_group()
         result = self.api_client.deployments.create_or_update(
             resource_group_name=self.resourceGroup["name"],
             deployment_name=self.name,
             properties=self.deploymentProperties
         )
+        # The fingerprint is only recorded once the deployment is accepted,
+        # and is ignored by is_up_to_date() unless the deployment succeeds
+        tags = dict(resource_group.tags or {})
+        tags[self.fingerprintTag] = self.fingerprint
+        self.api_client.resource_groups.update(
+            self.resourceGroup["name"],
+            {"tags": tags}
+        )
         if wait:
             result.wait()
 
@@ -178,9 +263,31 @@ class AzureStack(gpwm.stacks.BaseStack):
         print(json.dumps(self.deploymentProperties, indent=2))
 
     def create_resource_group(self):
+        """ Creates or updates the resource group of the deployment
+
+        create_or_update() replaces all the tags of the group, so the
+        fingerprint tags of all the deployments in the group (see
+        fingerprintTag) are carried over.
+        """
+        parameters = self.resourceGroupParameters
+        try:
+            current = self.api_client.resource_groups.get(
+                self.resourceGroup["name"]
+            )
+        except CloudError:
+            current = None
+        fingerprints = {
+            k: v for k, v in ((current and current.tags) or {}).items()
+            if k.startswith(f"{gpwm.stacks.FINGERPRINT_KEY}_")
+        }
+        if fingerprints:
+            parameters["tags"] = dict(
+                fingerprints,
+                **(parameters.get("tags") or {})
+            )
         return self.api_client.resource_groups.create_or_update(
             self.resourceGroup["name"],
-            self.resourceGroupParameters
+            parameters
         )
 
     def delete_resource_group(self):
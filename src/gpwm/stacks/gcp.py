@@ -14,14 +14,24 @@
 
 
 from __future__ import print_function
+import os
+import random
 import time
 import yaml
 
 
 from apiclient.errors import HttpError
 
+import gpwm.renderers
 from gpwm.sessions import GCP as GCPSession
 import gpwm.stacks
+import gpwm.utils
+
+
+# Operations are polled after WAIT_MIN_INTERVAL seconds, doubling the
+# interval (with jitter) up to WAIT_MAX_INTERVAL
+WAIT_MIN_INTERVAL = 1
+WAIT_MAX_INTERVAL = 30
 
 
 class GCPStack(gpwm.stacks.BaseStack):
@@ -55,8 +65,17 @@ class GCPStack(gpwm.stacks.BaseStack):
         labels = self.labels.copy()
         if isinstance(labels, dict):
             self.labels = [{"key": k, "value": v} for k, v in labels.items()]
-        self.labels.append({"key": "build_id", "value": self.BuildId})
         self.target = self.assemble_target()
+        self.fingerprint_label = {
+            "key": gpwm.stacks.FINGERPRINT_KEY,
+            "value": gpwm.stacks.get_fingerprint(
+                self.target,
+                getattr(self, "description", None),
+                self.labels
+            )
+        }
+        self.labels.append({"key": "build_id", "value": self.BuildId})
+        self.labels.append(self.fingerprint_label)
         self.body = self.assemble_body()
 
     def assemble_target(self):
@@ -66,12 +85,16 @@ class GCPStack(gpwm.stacks.BaseStack):
         the DM's API, so we have to reorder the arguments before feeding them
         to the API.
 
+        Imports can be local paths or remote URLs, like any other template.
         """
         # build imports
         imports = []
+        gpwm.renderers.prefetch_templates(
+            i["path"] for i in getattr(self, "imports", [])
+        )
         for i in getattr(self, "imports", []):
-            with open(i["path"]) as f:
-                content = f.read().rstrip()
+            parsed_url, content = gpwm.renderers.get_template_body(i["path"])
+            content = content.rstrip()
             imports.append(
                 {
                     "content": content,
@@ -87,7 +110,7 @@ class GCPStack(gpwm.stacks.BaseStack):
         return {
             "imports": imports,
             "config": {
-                "content": yaml.dump(
+                "content": gpwm.utils.dump_yaml(
                     config,
                     indent=2,
                     default_flow_style=False
@@ -128,52 +151,110 @@ class GCPStack(gpwm.stacks.BaseStack):
                 "HTTP error {}: {}".format(exc.resp["status"], exc.content)
             )
 
-    def wait(self, interval=5, timeout=300):
-        """ A waiter for stack completeness
+    def wait(self, operation, timeout=None):
+        """ Waits for a Deployment Manager operation to complete
 
-        GCP SDK doesn't provide a waiter, so improvising a quick one here.
+        The operation is polled with exponential backoff plus jitter, and
+        every change of its status/progress is printed.
 
         Args:
-            interval(int): Interval between probes in seconds
-            timeout(int): The total wait timeout in seconds
+            operation(dict): The operation returned by insert, update or
+                delete
+            timeout(int): The total wait timeout in seconds. Defaults to the
+                GPWM_WAIT_TIMEOUT env variable or 3600
 
+        Raises SystemExit with the operation's errors if it fails, or if it
+        doesn't complete before the timeout.
         """
-        n_probes = int(timeout/interval)
-        for i in range(0, n_probes):
-            time.sleep(interval)
-            deployment = self.get()
-            if deployment and deployment["operation"]["status"] == "DONE":
-                break
+        if timeout is None:
+            timeout = float(os.environ.get("GPWM_WAIT_TIMEOUT", "3600"))
+        deadline = time.monotonic() + timeout
+        interval = WAIT_MIN_INTERVAL
+        progress = None
+        while operation["status"] != "DONE":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SystemExit(
+                    f"Timed out waiting for operation {operation['name']} "
+                    f"of deployment {self.name}"
+                )
+            time.sleep(min(interval * random.uniform(0.5, 1), remaining))
+            interval = min(interval * 2, WAIT_MAX_INTERVAL)
+            operation = GCPSession().client.operations().get(
+                project=self.project,
+                operation=operation["name"]
+            ).execute()
+            if (operation["status"], operation.get("progress")) != progress:
+                progress = (operation["status"], operation.get("progress"))
+                print(
+                    f"{self.name} {operation.get('operationType', '')} "
+                    f"{operation['status']} {operation.get('progress', 0)}%"
+                )
+
+        errors = operation.get("error", {}).get("errors", [])
+        if errors:
+            raise SystemExit(
+                f"Operation {operation['name']} of deployment {self.name} "
+                "failed:\n" + "\n".join(
+                    f"{e.get('code')}: {e.get('message')}" for e in errors
+                )
+            )
 
     def create(self, wait=False):
-        GCPSession().client.deployments().insert(
+        operation = GCPSession().client.deployments().insert(
             project=self.project,
             body=self.body
         ).execute()
         if wait:
-            self.wait()
+            self.wait(operation)
 
     def delete(self, wait=False):
         if not self.get():
             raise SystemExit("Deployment doesn't exist: {}".format(self.name))
-        GCPSession().client.deployments().delete(
+        operation = GCPSession().client.deployments().delete(
             project=self.project,
             deployment=self.name
         ).execute()
         if wait:
-            self.wait()
+            self.wait(operation)
 
-    def update(self, wait=False, review=False):
-        GCPSession().client.deployments().insert(
+    def is_up_to_date(self, deployment):
+        """ Returns True if the deployment has the same fingerprint
+
+        Args:
+            deployment(dict): The deployment, as returned by get()
+        """
+        if gpwm.stacks.force_update() or not deployment:
+            return False
+        operation = deployment.get("operation", {})
+        if operation.get("status") != "DONE" or operation.get("error"):
+            return False
+        return self.fingerprint_label in deployment.get("labels", [])
+
+    def update(self, wait=False, review=False, deployment=None):
+        """ Updates the deployment, unless its fingerprint didn't change
+
+        Args:
+            deployment(dict): The current deployment, if already fetched
+        """
+        deployment = deployment or self.get()
+        if self.is_up_to_date(deployment):
+            print(f"===> {self.name} is up to date, skipping update")
+            return
+        # updates must carry the fingerprint of the current deployment
+        body = dict(self.body, fingerprint=deployment.get("fingerprint"))
+        operation = GCPSession().client.deployments().update(
             project=self.project,
-            body=self.body
+            deployment=self.name,
+            body=body
         ).execute()
         if wait:
-            self.wait()
+            self.wait(operation)
 
     def upsert(self, wait=False):
-        if self.get():
-            self.update(wait=wait)
+        deployment = self.get()
+        if deployment:
+            self.update(wait=wait, deployment=deployment)
         else:
             self.create(wait=wait)
 
@@ -17,9 +17,9 @@ from __future__ import print_function
 import logging
 import os
 import subprocess
-import yaml
 
 import gpwm.stacks
+import gpwm.utils
 
 
 class ShellStack(gpwm.stacks.BaseStack):
@@ -124,4 +124,4 @@ class ShellStack(gpwm.stacks.BaseStack):
         self._execute(action="Update")
 
     def render(self, wait=False):
-        print(yaml.dump(self.Actions, indent=2))
+        print(gpwm.utils.dump_yaml(self.Actions, indent=2))
@@ -17,17 +17,48 @@
 """
 
 
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import threading
 import yaml
 
-import boto3
 import jmespath
 
+import gpwm.caches
 from gpwm.sessions import AWS as AWSSession
+from gpwm.sessions import AWSClients
 from gpwm.sessions import AzureClient
+from gpwm.sessions import aws_region
+from gpwm.sessions import get_aws_region
 from gpwm.sessions import GCP as GCPSession
 
 STACK_CACHE = {}
-CF_STACK_RESOURCE_CACHE = {}
+STACK_CACHE_LOCKS = collections.defaultdict(threading.Lock)
+ACCOUNT_SCOPES = {}
+AWS_CALL_CACHE = {}
+# Only calls of read-only actions are cached by call_aws()
+AWS_CACHED_ACTION_PREFIXES = ["describe_", "get_", "list_", "lookup_"]
+# Actions matching those prefixes that return something new on every call:
+# random values, credentials, tokens and iterators
+AWS_NEVER_CACHED_ACTIONS = [
+    "secretsmanager:get_random_password",
+    "sts:get_session_token",
+    "sts:get_federation_token",
+    "ecr:get_authorization_token",
+    "ecr-public:get_authorization_token",
+    "codeartifact:get_authorization_token",
+    "redshift:get_cluster_credentials",
+    "redshift-serverless:get_credentials",
+    "cognito-identity:get_credentials_for_identity",
+    "cognito-identity:get_open_id_token",
+    "kinesis:get_shard_iterator",
+    "dynamodbstreams:get_shard_iterator"
+]
+# Results that are never written to the on-disk cache
+AWS_SECRET_SERVICES = ["secretsmanager", "kms", "sts"]
 YAML_TAGS = [
     "!Cloudformation",
     "!AWS",
@@ -35,9 +66,18 @@ YAML_TAGS = [
     "!ARM",
     "!GCPDM"
 ]
-
-
-def yaml_cloudformation_constructor(loader, node):
+# The arguments identifying the stack/deployment a tag reads from
+YAML_TAG_GROUPS = {
+    "!Cloudformation": ["stack"],
+    "!ARM": ["subscription", "resource-group", "deployment"],
+    "!GCPDM": ["project", "deployment"],
+    "!SSM": ["WithDecryption"]
+}
+# The maximum number of names of a ssm.get_parameters() call
+SSM_BATCH_SIZE = 10
+
+
+def yaml_cloudformation_resolver(arguments):
     """ Implements the yaml tag !Cloudformation
 
     The tag takes a dict {stack: $stack_name, output: output_key}
@@ -47,17 +87,16 @@ def yaml_cloudformation_constructor(loader, node):
       VpcId: !Cloudformation {stack: ${vpc_stack}, output: VPC}
       VpcId: !Cloudformation {stack: ${vpc_stack}, resource_id: VPC}
     """
-    output_dict = loader.construct_mapping(node)
-    stack = output_dict["stack"]
-    if "output" in output_dict.keys():
-        return get_aws_stack_output(stack=stack, output=output_dict["output"])
-    elif "resource_id" in output_dict.keys():
-        return get_stack_resource(stack, output_dict["resource_id"])
+    stack = arguments["stack"]
+    if "output" in arguments.keys():
+        return get_aws_stack_output(stack=stack, output=arguments["output"])
+    elif "resource_id" in arguments.keys():
+        return get_stack_resource(stack, arguments["resource_id"])
     else:
         raise SystemExit("Either 'output' or 'resource_id' must be provided")
 
 
-def yaml_ssm_constructor(loader, node):
+def yaml_ssm_resolver(arguments):
     """ Implements the yaml tag !SSM
 
     The tag takes the same arguments as SSM's GetParameter call:
@@ -68,15 +107,53 @@ def yaml_ssm_constructor(loader, node):
       SomeValue: !SSM {Name: /some/parameter/name}
       SomePassword: !SSM {Name: /some/name, WithDecryption: true}
     """
-    args = loader.construct_mapping(node)
     return call_aws(
         service="ssm",
         action="get_parameter",
-        arguments=args
+        arguments=arguments
     )["Parameter"]["Value"]
 
 
-def yaml_aws_constructor(loader, node):
+def yaml_ssm_batch_resolver(arguments_list):
+    """ Resolves many !SSM tags with as few API calls as possible
+
+    The parameters are read by GetParameters, SSM_BATCH_SIZE names per
+    call. All the tags must have the same WithDecryption value (see
+    YAML_TAG_GROUPS). GetParametersByPath isn't used, as it also returns
+    at most 10 parameters per call, plus the ones not referenced.
+
+    Args:
+        arguments_list(list): The arguments of each tag
+
+    Returns: The values of the parameters, in the same order
+
+    Raises SystemExit listing all the parameters not found.
+    """
+    names = list(dict.fromkeys(a["Name"] for a in arguments_list))
+    with_decryption = bool(arguments_list[0].get("WithDecryption"))
+    values = {}
+    missing = []
+    for i in range(0, len(names), SSM_BATCH_SIZE):
+        response = call_aws(
+            service="ssm",
+            action="get_parameters",
+            arguments={
+                "Names": names[i:i + SSM_BATCH_SIZE],
+                "WithDecryption": with_decryption
+            }
+        )
+        for parameter in response["Parameters"]:
+            name = parameter["Name"] + parameter.get("Selector", "")
+            values[name] = parameter["Value"]
+            if "ARN" in parameter:
+                values[parameter["ARN"]] = parameter["Value"]
+        missing.extend(response.get("InvalidParameters", []))
+    if missing:
+        raise SystemExit(f"SSM parameters not found: {', '.join(missing)}")
+    return [values[a["Name"]] for a in arguments_list]
+
+
+def yaml_aws_resolver(arguments):
     """ Implements the yaml tag !AWS
 
     The tag takes a dict like this as node (argument):
@@ -89,12 +166,13 @@ def yaml_aws_constructor(loader, node):
           arguments: {Filters: [{Name: "tag:team", Values: [sometag]}]},
           result_filter: "Vpcs[].VpcId"
       }
+
+    The result is cached (see call_aws()), unless "cache: false" is given.
     """
-    args_dict = loader.construct_mapping(node, deep=True)
-    return call_aws(**args_dict)
+    return call_aws(**arguments)
 
 
-def yaml_arm_constructor(loader, node):
+def yaml_arm_resolver(arguments):
     """ Implements the '!ARM' YAML tag
 
     The tag takes a yaml mapping like this as node (argument):
@@ -103,19 +181,18 @@ def yaml_arm_constructor(loader, node):
     Example:
       storageAccount: !ARM {resource-group: ${storage_resource_group}, deployment=${stack}, output: ${storageName}}
     """
-    output_dict = loader.construct_mapping(node)
     return get_azure_stack_output(
-        resource_group=output_dict["resource-group"],
-        deployment=output_dict["deployment"],
-        output=output_dict["output"],
-        subscription=output_dict.get("subscription")
+        resource_group=arguments["resource-group"],
+        deployment=arguments["deployment"],
+        output=arguments["output"],
+        subscription=arguments.get("subscription")
     )
 #    elif "resource-id" in output_dict.keys():
 #        return get_stack_resource(stack_name, output_dict["resource_id"])
 #    else:
 
 
-def yaml_gcpdm_constructor(loader, node):
+def yaml_gcpdm_resolver(arguments):
     """ Implements the yaml tag !GCPDM
 
     The tag takes a dict as node value:
@@ -124,27 +201,187 @@ def yaml_gcpdm_constructor(loader, node):
     Example:
       VpcId: !GCPDM {project: platform, deployment: core-network, output: VPC}
     """
-    output_dict = loader.construct_mapping(node)
-    if "output" in output_dict.keys():
+    if "output" in arguments.keys():
         return get_gcp_stack_output(
-            project=output_dict["project"],
-            deployment=output_dict["deployment"],
-            output=output_dict["output"]
+            project=arguments["project"],
+            deployment=arguments["deployment"],
+            output=arguments["output"]
         )
     else:
         raise SystemExit("Either 'output' or 'resource' must be provided")
 
 
+class DeferredTag(object):
+    """ A YAML tag of this tool, resolved after the document is loaded
+
+    Loading a document only records the tags and their arguments. The API
+    calls are made later by resolve_tags(), for all the tags in the
+    document at once.
+
+    Args:
+        tag(str): The YAML tag, for example !Cloudformation
+        arguments(dict): The tag's arguments
+    """
+    def __init__(self, tag, arguments):
+        self.tag = tag
+        self.arguments = arguments
+
+    def __repr__(self):
+        return f"{self.tag} {self.arguments}"
+
+    @property
+    def key(self):
+        """ Identifies tags with the exact same arguments """
+        return (
+            self.tag,
+            json.dumps(self.arguments, sort_keys=True, default=str)
+        )
+
+    @property
+    def group(self):
+        """ Identifies tags resolved by the same API round trip
+
+        Tags reading outputs of the same stack/deployment belong to the
+        same group. Other tags are only grouped with identical tags.
+        """
+        if self.tag in YAML_TAG_GROUPS:
+            return (self.tag,) + tuple(
+                self.arguments.get(k) for k in YAML_TAG_GROUPS[self.tag]
+            )
+        return self.key
+
+    def resolve(self):
+        function = globals()[f"yaml_{self.tag[1:]}_resolver".lower()]
+        return function(self.arguments)
+
+    @staticmethod
+    def resolve_many(tags):
+        """ Resolves a group of tags
+
+        If the tag has a batch resolver (yaml_*_batch_resolver), all the
+        tags are resolved by a single call to it, otherwise one by one.
+
+        Args:
+            tags(list): DeferredTag objects of the same group
+
+        Returns: A list with the values of the tags
+        """
+        function = globals().get(
+            f"yaml_{tags[0].tag[1:]}_batch_resolver".lower()
+        )
+        if function and len(tags) > 1:
+            return function([t.arguments for t in tags])
+        return [t.resolve() for t in tags]
+
+
+def find_tags(data):
+    """ Returns all the DeferredTag objects in a loaded YAML document
+    """
+    if isinstance(data, DeferredTag):
+        return [data]
+    if isinstance(data, dict):
+        data = data.values()
+    elif not isinstance(data, list):
+        return []
+    return [tag for item in data for tag in find_tags(item)]
+
+
+def replace_tags(data, values):
+    """ Replaces DeferredTag objects by their resolved values
+
+    Args:
+        data: A loaded YAML document
+        values(dict): Maps a DeferredTag's key to its value
+    """
+    if isinstance(data, DeferredTag):
+        return values[data.key]
+    if isinstance(data, dict):
+        return {k: replace_tags(v, values) for k, v in data.items()}
+    if isinstance(data, list):
+        return [replace_tags(i, values) for i in data]
+    return data
+
+
+def resolve_tags(data, workers=None):
+    """ Resolves all the YAML tags of this tool in a loaded document
+
+    The tags are deduplicated, and grouped so all tags reading the same
+    stack/deployment are resolved by the same worker, after a single
+    lookup. Tags with a batch resolver, like !SSM, are resolved by as few
+    calls as possible. The groups are resolved concurrently.
+
+    Tags can be nested in the arguments of other tags, for example
+    !Cloudformation {stack: !SSM {Name: /vpc/stack}, output: VPC}. The
+    inner tags are resolved first, one pass per nesting level.
+
+    AWS tags are resolved in the region of the calling thread (see
+    gpwm.sessions.aws_region()), and cached per region.
+
+    Args:
+        data: A document loaded with load_yaml()
+        workers(int): The maximum number of concurrent groups. Defaults to
+            GPWM_TAG_WORKERS env variable or 8
+
+    Returns: The document with the values of the tags
+    """
+    tags = {tag.key: tag for tag in find_tags(data)}
+    if not tags:
+        return data
+
+    # tags with the values of their nested tags as arguments
+    nested = {k: t for k, t in tags.items() if find_tags(t.arguments)}
+    resolved = dict(tags)
+    if nested:
+        arguments = resolve_tags(
+            [t.arguments for t in nested.values()],
+            workers
+        )
+        for (key, tag), tag_arguments in zip(nested.items(), arguments):
+            resolved[key] = DeferredTag(tag.tag, tag_arguments)
+
+    groups = {}
+    for tag in resolved.values():
+        groups.setdefault(tag.group, {})[tag.key] = tag
+
+    values = {}
+    # the workers resolve the tags in the region of the calling thread
+    region = get_aws_region()
+
+    def resolve_group(tags):
+        with aws_region(region):
+            values.update(zip(
+                tags.keys(),
+                DeferredTag.resolve_many(list(tags.values()))
+            ))
+
+    if len(groups) == 1:
+        resolve_group(*groups.values())
+    else:
+        workers = workers or int(os.environ.get("GPWM_TAG_WORKERS", "8"))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as p:
+            # list() re-raises the first exception of the groups, if any
+            list(p.map(resolve_group, groups.values()))
+    return replace_tags(
+        data,
+        {key: values[tag.key] for key, tag in resolved.items()}
+    )
+
+
 def yaml_constructor(loader, tag_suffix, node):
     """ Handles YAML tags used in this tool
 
+    The tags of this tool are loaded as DeferredTag objects, to be resolved
+    by resolve_tags().
+
     If the tag in not specific to this tool, the yaml Node() object is
     returned, so it can be rendered back into YAML by the *representer*
     function.
     """
     if tag_suffix in YAML_TAGS:
-        function = globals()[f"yaml_{tag_suffix[1:]}_constructor".lower()]
-        return function(loader, node)
+        return DeferredTag(
+            tag_suffix,
+            loader.construct_mapping(node, deep=True)
+        )
     return node
 #    if not node.value:
 #        return node.tag
@@ -164,71 +401,507 @@ yaml.add_multi_constructor("", yaml_constructor)
 yaml.add_multi_representer(yaml.nodes.Node, yaml_representer)
 
 
+# libyaml's C parser and emitter are much faster than the pure Python ones,
+# but aren't always installed
+try:
+    from yaml import CSafeLoader as BaseLoader
+    from yaml import CDumper as BaseDumper
+except ImportError:
+    from yaml import SafeLoader as BaseLoader
+    from yaml import Dumper as BaseDumper
+
+
+class Loader(BaseLoader):
+    """ YAML loader supporting the tags of this tool
+
+    Backed by libyaml (CSafeLoader) when available. Only safe YAML is
+    loaded, plus the tags handled by yaml_constructor().
+    """
+
+
+class Dumper(BaseDumper):
+    """ YAML dumper able to dump the provider tags kept by Loader
+
+    Backed by libyaml (CDumper) when available.
+    """
+
+
+Loader.add_multi_constructor("", yaml_constructor)
+Dumper.add_multi_representer(yaml.nodes.Node, yaml_representer)
+
+
+def load_yaml(stream):
+    """ Loads a YAML document with Loader
+
+    The tags of this tool are not resolved, see resolve_tags().
+    """
+    return yaml.load(stream, Loader=Loader)
+
+
+def dump_yaml(data, **kwargs):
+    """ Dumps data as YAML with Dumper
+
+    Args:
+        data: The data to be dumped
+        kwargs(dict): Keyword arguments to yaml.dump(), for example indent
+    """
+    return yaml.dump(data, Dumper=Dumper, **kwargs)
+
+
+def node_to_json(node):
+    """ Converts a YAML node kept by Loader into JSON serializable data
+
+    The short form of Cloudformation's intrinsic functions only exists in
+    YAML, so they're converted into their long form, for example:
+
+        !Ref vpc            -> {"Ref": "vpc"}
+        !GetAtt vpc.CidrBlock -> {"Fn::GetAtt": ["vpc", "CidrBlock"]}
+        !Sub "${AWS::Region}" -> {"Fn::Sub": "${AWS::Region}"}
+    """
+    if not node.tag.startswith("!"):
+        if isinstance(node, yaml.SequenceNode):
+            return [node_to_json(i) for i in node.value]
+        if isinstance(node, yaml.MappingNode):
+            return {node_to_json(k): node_to_json(v) for k, v in node.value}
+        return yaml.constructor.SafeConstructor().construct_object(node)
+
+    function = node.tag[1:]
+    key = function if function in ["Ref", "Condition"] else f"Fn::{function}"
+    if isinstance(node, yaml.ScalarNode):
+        value = node.value
+        if function == "GetAtt":
+            value = value.split(".", 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = [node_to_json(i) for i in node.value]
+    else:
+        value = {node_to_json(k): node_to_json(v) for k, v in node.value}
+    return {key: value}
+
+
+def dump_json(data, **kwargs):
+    """ Dumps data loaded by Loader as compact JSON
+
+    Args:
+        data: The data to be dumped
+        kwargs(dict): Keyword arguments to json.dumps()
+    """
+    def default(value):
+        if isinstance(value, yaml.nodes.Node):
+            return node_to_json(value)
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    kwargs.setdefault("separators", (",", ":"))
+    return json.dumps(data, default=default, **kwargs)
+
+
+def get_output_cache(provider, *scope):
+    """ Returns the persistent output cache for a provider scope
+
+    Stack outputs are only cached across runs if GPWM_OUTPUT_CACHE is set:
+        - validate: Cached outputs are used only if the stack didn't change
+          since they were cached (LastUpdatedTime and status for
+          Cloudformation,
+          timestamp for ARM, fingerprint for GCP DM). The check is a single
+          metadata call per stack.
+        - ttl: Cached outputs are used without any checks if they were cached
+          less than GPWM_OUTPUT_CACHE_TTL seconds ago (defaults to 300).
+
+    Args:
+        provider(str): aws, azure or gcp
+        scope(str): What identifies where the stacks live, for example the
+            AWS account and region
+
+    Returns: A tuple with a gpwm.caches.JsonCache object (or None if the
+        output cache is disabled) and the TTL (None in validate mode)
+    """
+    mode = os.environ.get("GPWM_OUTPUT_CACHE", "")
+    if not mode:
+        return None, None
+    if mode not in ["validate", "ttl"]:
+        raise SystemExit(f"Invalid GPWM_OUTPUT_CACHE: {mode}")
+    cache = gpwm.caches.JsonCache("outputs", provider, *scope)
+    if mode == "ttl":
+        return cache, float(os.environ.get("GPWM_OUTPUT_CACHE_TTL", "300"))
+    return cache, None
+
+
+def get_cached_outputs(cache, ttl, name, get_stamp, get_outputs):
+    """ Returns the outputs of a stack, going through the output cache
+
+    Args:
+        cache(JsonCache): The output cache, or None if disabled
+        ttl(float): The TTL of the cache, or None in validate mode
+        name(str): The name of the stack/deployment
+        get_stamp(callable): Returns what changes whenever the stack changes
+            (the metadata call)
+        get_outputs(callable): Returns the outputs as a dict. Only called if
+            the cached outputs can't be used.
+
+    Returns: A dict with the stack outputs
+    """
+    if cache is None:
+        get_stamp()
+        return get_outputs()
+
+    entry = cache.get(name, ttl=ttl)
+    if entry and ttl is not None:
+        return entry["outputs"]
+    stamp = get_stamp()
+    if entry and entry["stamp"] == stamp:
+        return entry["outputs"]
+    outputs = get_outputs()
+    cache.set(name, {"stamp": stamp, "outputs": outputs})
+    return outputs
+
+
+def get_aws_account_scope():
+    """ Returns the AWS account id and region of the current credentials
+    """
+    key = ("aws", get_aws_region())
+    if key not in ACCOUNT_SCOPES:
+        client = AWSClients().get("sts")
+        account = client.get_caller_identity()["Account"]
+        ACCOUNT_SCOPES[key] = (account, client.meta.region_name)
+    return ACCOUNT_SCOPES[key]
+
+
+def forget_stack(name):
+    """ Drops everything cached about a stack/deployment
+
+    Used after a stack is changed, so the stacks depending on it see its new
+    outputs and resources, in every region. Both STACK_CACHE and the
+    on-disk output cache (see get_output_cache()) are cleared, so the "ttl"
+    mode doesn't serve outputs older than the change. The export indexes
+    are dropped too.
+    """
+    for key in list(STACK_CACHE):
+        if key[-1] == name or key[0] == "aws-exports":
+            STACK_CACHE.pop(key, None)
+    gpwm.caches.delete_key(name, "outputs")
+    gpwm.caches.delete_key("exports", "outputs", "aws")
+
+
+def get_aws_stack_outputs(stack):
+    """ Returns the outputs of a Cloudformation stack as a dict
+    """
+    # the account scope costs an API call, so only when actually needed
+    cache, ttl = None, None
+    if os.environ.get("GPWM_OUTPUT_CACHE"):
+        cache, ttl = get_output_cache("aws", *get_aws_account_scope())
+    description = {}
+
+    def get_stamp():
+        description.update(
+            AWSSession().client.describe_stacks(StackName=stack)["Stacks"][0]
+        )
+        # LastUpdatedTime is set when an update starts, so the status
+        # tells outputs read during the update from the final ones
+        updated = description.get(
+            "LastUpdatedTime",
+            description["CreationTime"]
+        )
+        return f"{updated} {description.get('StackStatus')}"
+
+    def get_outputs():
+        return {
+            o["OutputKey"]: o["OutputValue"]
+            for o in description.get("Outputs", [])
+        }
+
+    return get_cached_outputs(cache, ttl, stack, get_stamp, get_outputs)
+
+
+def get_stack_index(key, get_index):
+    """ Returns the index of a stack/deployment from STACK_CACHE
+
+    The index (a dict of outputs, for example) is built only once per run,
+    even when many threads look up the same stack at the same time, and
+    every lookup after that is a single dict access.
+
+    Args:
+        key(tuple): The provider and what identifies the stack
+        get_index(callable): Builds the index, only called on a cache miss
+    """
+    if key not in STACK_CACHE:
+        with STACK_CACHE_LOCKS[key]:
+            if key not in STACK_CACHE:
+                STACK_CACHE[key] = get_index()
+    return STACK_CACHE[key]
+
+
+def get_aws_exports():
+    """ Returns all the Cloudformation exports of the region as a dict
+
+    The exports are read by a single paginated list_exports sweep. In the
+    "ttl" mode of the output cache (see get_output_cache()), the exports
+    are also cached on disk.
+    """
+    cache, ttl = None, None
+    if os.environ.get("GPWM_OUTPUT_CACHE") == "ttl":
+        cache, ttl = get_output_cache("aws", *get_aws_account_scope())
+        exports = cache.get("exports", ttl=ttl)
+        if exports is not None:
+            return exports
+
+    paginator = AWSSession().client.get_paginator("list_exports")
+    exports = {
+        e["Name"]: e["Value"]
+        for page in paginator.paginate()
+        for e in page["Exports"]
+    }
+    if cache:
+        cache.set("exports", exports)
+    return exports
+
+
 def get_aws_stack_output(stack, output):
-    if not STACK_CACHE.get(stack):
-        STACK_CACHE[stack] = AWSSession().resource.Stack(stack)
+    """ Returns an output of a Cloudformation stack, or None
 
-    for stack_output in STACK_CACHE[stack].outputs:
-        if stack_output["OutputKey"] == output:
-            return stack_output["OutputValue"]
+    If the GPWM_EXPORT_INDEX env variable is set, outputs are first looked
+    up in the index of all the exports of the region (see
+    get_aws_exports()), by the name parse_mako()/parse_jinja() export
+    them with: {stack}-{output}. Only outputs not exported that way need
+    the stack to be described.
+    """
+    if os.environ.get("GPWM_EXPORT_INDEX"):
+        exports = get_stack_index(
+            ("aws-exports", get_aws_region()),
+            get_aws_exports
+        )
+        if f"{stack}-{output}" in exports:
+            return exports[f"{stack}-{output}"]
+    outputs = get_stack_index(
+        ("aws", get_aws_region(), stack),
+        lambda: get_aws_stack_outputs(stack)
+    )
+    return outputs.get(output)
 
 
-def get_azure_stack_output(
-        resource_group, deployment, output, subscription=None):
-    if not STACK_CACHE.get(deployment):
-        api_client = AzureClient().get("resource.ResourceManagementClient")
-        STACK_CACHE[deployment] = api_client.deployments.get(
+def get_azure_stack_outputs(resource_group, deployment, subscription=None):
+    """ Returns the outputs of an ARM deployment as a dict
+    """
+    subscription = subscription or os.environ.get("AZURE_SUBSCRIPTION", "")
+    cache, ttl = get_output_cache("azure", subscription, resource_group)
+    result = {}
+
+    def get_stamp():
+        api_client = AzureClient().get(
+            "resource.ResourceManagementClient",
+            subscription=subscription or None
+        )
+        result["deployment"] = api_client.deployments.get(
             deployment_name=deployment,
             resource_group_name=resource_group
         )
-    if STACK_CACHE[deployment].properties.outputs is None:
-        return None
+        return str(result["deployment"].properties.timestamp)
 
-    # deployment has outputs if not None
-    for k, v in STACK_CACHE[deployment].properties.outputs.items():
-        if k == output:
-            return v["value"]
+    def get_outputs():
+        outputs = result["deployment"].properties.outputs or {}
+        return {k: v["value"] for k, v in outputs.items()}
 
+    return get_cached_outputs(cache, ttl, deployment, get_stamp, get_outputs)
 
-def get_gcp_stack_output(project, deployment, output):
-    if not STACK_CACHE.get(deployment):
-        deployment_result = GCPSession().client.deployments().get(
+
+def get_azure_stack_output(
+        resource_group, deployment, output, subscription=None):
+    outputs = get_stack_index(
+        ("azure", subscription, resource_group, deployment),
+        lambda: get_azure_stack_outputs(
+            resource_group,
+            deployment,
+            subscription
+        )
+    )
+    return outputs.get(output)
+
+
+def get_gcp_stack_outputs(project, deployment):
+    """ Returns the outputs of a Deployment Manager deployment as a dict
+
+    The outputs live in the layout of the deployment's manifest, which is
+    only fetched (and parsed) when the deployment's fingerprint changed.
+    """
+    cache, ttl = get_output_cache("gcp", project)
+    result = {}
+
+    def get_stamp():
+        result["deployment"] = GCPSession().client.deployments().get(
             project=project,
             deployment=deployment
         ).execute()
+        return result["deployment"]["fingerprint"]
+
+    def get_outputs():
         manifest = GCPSession().client.manifests().get(
             project=project,
             deployment=deployment,
-            manifest=deployment_result["manifest"].split("/")[-1]
-            ).execute()
-        STACK_CACHE[deployment] = {
-            "deployment": deployment_result,
-            "manifest": manifest
+            manifest=result["deployment"]["manifest"].split("/")[-1]
+        ).execute()
+        layout = load_yaml(manifest["layout"])
+        return {
+            o["name"]: o["finalValue"] for o in layout.get("outputs", [])
         }
-    layout = yaml.load(STACK_CACHE[deployment]["manifest"]["layout"])
-    for deployment_output in layout.get("outputs", []):
-        if deployment_output["name"] == output:
-            return deployment_output["finalValue"]
+
+    return get_cached_outputs(cache, ttl, deployment, get_stamp, get_outputs)
+
+
+def get_gcp_stack_output(project, deployment, output):
+    outputs = get_stack_index(
+        ("gcp", project, deployment),
+        lambda: get_gcp_stack_outputs(project, deployment)
+    )
+    return outputs.get(output)
 
 
 def get_stack_output(stack_name, output_key, provider="aws", **kwargs):
-    cmd = locals()[f"get_{provider}_stack_output"]
-    return cmd(stack_name=stack_name, output_key=output_key, **kwargs) or ""
+    """ Returns an output of another stack, for use in templates
+
+    Example (mako):
+        vpc_id = utils.get_stack_output("vpc-demo-dev", "VPC")
+        vnet = utils.get_stack_output(
+            "vnet", "vnet", provider="azure", resource_group="network")
+        vpc = utils.get_stack_output(
+            "network", "vpc", provider="gcp", project="platform")
+
+    Returns: The output value, or an empty string if not found
+    """
+    if provider == "aws":
+        value = get_aws_stack_output(stack_name, output_key)
+    elif provider == "azure":
+        value = get_azure_stack_output(
+            resource_group=kwargs["resource_group"],
+            deployment=stack_name,
+            output=output_key,
+            subscription=kwargs.get("subscription")
+        )
+    elif provider == "gcp":
+        value = get_gcp_stack_output(
+            kwargs["project"],
+            stack_name,
+            output_key
+        )
+    else:
+        raise SystemExit(f"Provider not supported: {provider}")
+    return value or ""
+
+
+def get_aws_stack_resources(stack):
+    """ Returns the physical IDs of a Cloudformation stack's resources
+
+    All the resources are read by a single paginated list_stack_resources
+    sweep.
+
+    Returns: A dict mapping logical IDs to physical IDs
+    """
+    paginator = AWSSession().client.get_paginator("list_stack_resources")
+    return {
+        r["LogicalResourceId"]: r.get("PhysicalResourceId")
+        for page in paginator.paginate(StackName=stack)
+        for r in page["StackResourceSummaries"]
+    }
 
 
 def get_stack_resource(stack_name, resource_id):
-    # caching results of calls to clouformation API
-    if not CF_STACK_RESOURCE_CACHE.get(stack_name):
-        CF_STACK_RESOURCE_CACHE[stack_name] = {}
-    if not CF_STACK_RESOURCE_CACHE[stack_name].get(resource_id):
-        CF_STACK_RESOURCE_CACHE[stack_name][resource_id] = \
-            CF_STACK_RESOURCE_CACHE.StackResource(stack_name, resource_id)
-    return CF_STACK_RESOURCE_CACHE[stack_name][resource_id].physical_resource_id # noqa
-
-
-def call_aws(service, action, arguments={}, result_filter=None):
-    client = boto3.client(service)
-    result = getattr(client, action)(**arguments)
+    """ Returns the physical ID of a resource of a Cloudformation stack
+
+    The resources of each stack are indexed once, see
+    get_aws_stack_resources().
+    """
+    resources = get_stack_index(
+        ("aws-resources", get_aws_region(), stack_name),
+        lambda: get_aws_stack_resources(stack_name)
+    )
+    if resource_id not in resources:
+        raise SystemExit(
+            f"Resource {resource_id} not found in stack {stack_name}"
+        )
+    return resources[resource_id]
+
+
+def is_aws_call_cacheable(service, action):
+    """ Returns True if the results of an AWS API action can be cached
+
+    Only read-only actions (see AWS_CACHED_ACTION_PREFIXES) are cached,
+    except the non-deterministic ones in AWS_NEVER_CACHED_ACTIONS. More
+    actions can be excluded with the GPWM_AWS_NEVER_CACHE env variable, a
+    comma separated list of actions or service:action, for example
+    "describe_spot_price_history,ec2:describe_instance_status".
+    """
+    never_cache = AWS_NEVER_CACHED_ACTIONS + \
+        os.environ.get("GPWM_AWS_NEVER_CACHE", "").split(",")
+    if action in never_cache or f"{service}:{action}" in never_cache:
+        return False
+    return any(action.startswith(p) for p in AWS_CACHED_ACTION_PREFIXES)
+
+
+def call_aws(service, action, arguments={}, result_filter=None, cache=True):
+    """ Calls an AWS API action, and filters the result with jmespath
+
+    Results of read-only actions are memoized in AWS_CALL_CACHE by service,
+    action, arguments and region, so the same lookup is made only once per
+    run. The result_filter is applied after the cache lookup, so calls
+    differing only by their filter share the result.
+
+    If the GPWM_AWS_CACHE_TTL env variable is set, results are also cached
+    on disk, in the "aws" cache, for that many seconds. Results that may
+    hold secrets (WithDecryption, AWS_SECRET_SERVICES) never are.
+
+    Args:
+        service(str): The boto3 service name, for example ec2
+        action(str): The client method, for example describe_vpcs
+        arguments(dict): The arguments of the action
+        result_filter(str): A jmespath expression
+        cache(bool): If False, the result is neither read from or written
+            to the caches
+    """
+    client = AWSClients().get(service)
+    if cache and is_aws_call_cacheable(service, action):
+        key = (
+            service,
+            action,
+            json.dumps(arguments, sort_keys=True, default=str),
+            client.meta.region_name
+        )
+        if key not in AWS_CALL_CACHE:
+            AWS_CALL_CACHE[key] = get_cached_aws_call(
+                key,
+                lambda: getattr(client, action)(**arguments),
+                secret=service in AWS_SECRET_SERVICES or
+                bool(arguments.get("WithDecryption"))
+            )
+        result = AWS_CALL_CACHE[key]
+    else:
+        result = getattr(client, action)(**arguments)
     if result_filter is None:
         return result
     return jmespath.search(result_filter, result)
+
+
+def get_cached_aws_call(key, call, secret=False):
+    """ Returns the result of an AWS call from the on-disk cache, if enabled
+
+    Helper for call_aws(). Cached results are scoped by account, and go
+    through JSON, so timestamps are strings.
+
+    Args:
+        key(tuple): The key of the call in AWS_CALL_CACHE
+        call(callable): Makes the API call
+        secret(bool): If True, the result is never cached on disk
+    """
+    ttl = os.environ.get("GPWM_AWS_CACHE_TTL")
+    if not ttl or secret:
+        result = call()
+        result.pop("ResponseMetadata", None)
+        return result
+
+    cache = gpwm.caches.JsonCache("aws", *get_aws_account_scope())
+    name = json.dumps(key)
+    result = cache.get(name, ttl=float(ttl))
+    if result is None:
+        result = call()
+        result.pop("ResponseMetadata", None)
+        result = json.loads(json.dumps(result, default=str))
+        cache.set(name, result)
+    return result
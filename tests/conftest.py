@@ -27,6 +27,14 @@ class Stack:
             self._dict.update(BuildId=self.build)
         return self._dict
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """ Keeps the on-disk caches of every test isolated """
+    path = tmp_path / "cache"
+    monkeypatch.setenv("GPWM_CACHE_DIR", str(path))
+    monkeypatch.delenv("GPWM_NO_CACHE", raising=False)
+    return path
+
 def render_mako(data, **params):
     tmpl = mako.template.Template(data)
     return tmpl.render(**params)
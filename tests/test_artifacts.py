@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import gpwm.utils
+from gpwm.artifacts import load_stack
+from gpwm.artifacts import read_artifact
+from gpwm.artifacts import write_artifact
+from gpwm.stacks.aws import CloudformationStack
+from gpwm.stacks.shell import ShellStack
+
+template = """
+Resources:
+  vpc:
+    Type: AWS::EC2::VPC
+    Properties:
+      CidrBlock: !Ref cidr
+      Tags: [{Key: created, Value: 2018-01-01}]
+"""
+
+
+@pytest.fixture
+def stack():
+    return CloudformationStack(
+        StackName="vpc",
+        TemplateBody=gpwm.utils.load_yaml(template),
+        Capabilities=["CAPABILITY_IAM"],
+        Tags={"team": "network"},
+        BuildId="1"
+    )
+
+
+def test_artifact_round_trip(stack, tmp_path):
+    path = str(tmp_path / "vpc.json")
+    write_artifact(path, "cloudformation", [("us-east-1", stack)])
+    artifact = read_artifact(path)
+    assert artifact["provider"] == "cloudformation"
+    assert artifact["deployments"][0]["region"] == "us-east-1"
+
+    restored = load_stack(artifact, artifact["deployments"][0])
+    assert isinstance(restored, CloudformationStack)
+    assert restored.Tags == stack.Tags
+    assert restored.Capabilities == ["CAPABILITY_IAM"]
+    properties = restored.TemplateBody["Resources"]["vpc"]["Properties"]
+    assert properties["CidrBlock"] == {"Ref": "cidr"}
+    # same stack, same fingerprint, so applying it doesn't update anything
+    assert restored.get_fingerprint() == stack.get_fingerprint()
+
+
+def test_shell_artifact(tmp_path):
+    stack = ShellStack(
+        Actions={"Create": {"Commands": "echo $BUILD_ID"}},
+        BuildId="1"
+    )
+    path = str(tmp_path / "shell.json")
+    write_artifact(path, "shell", [(None, stack)])
+    artifact = read_artifact(path)
+    restored = load_stack(artifact, artifact["deployments"][0])
+    assert isinstance(restored, ShellStack)
+    assert restored.__dict__ == stack.__dict__
+
+
+def test_read_artifact_exceptions(stack, tmp_path):
+    path = tmp_path / "vpc.json"
+    write_artifact(str(path), "cloudformation", [(None, stack)])
+    artifact = json.loads(path.read_text())
+    artifact["deployments"][0]["attributes"]["StackName"] = "other"
+    path.write_text(json.dumps(artifact))
+    with pytest.raises(SystemExit):
+        read_artifact(str(path))
+
+    artifact["version"] = 2
+    path.write_text(json.dumps(artifact))
+    with pytest.raises(SystemExit):
+        read_artifact(str(path))
+
+    with pytest.raises(SystemExit):
+        read_artifact(str(tmp_path / "missing.json"))
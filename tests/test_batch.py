@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from gpwm.batch import BatchStack
+from gpwm.batch import build_graph
+from gpwm.batch import find_stack_files
+from gpwm.batch import run
+
+vpc_stack = """
+StackName: vpc
+TemplateBody: vpc.mako
+"""
+
+subnet_stack = """
+StackName: subnet
+TemplateBody: subnet.mako
+Parameters:
+  vpc: !Cloudformation {stack: vpc, output: VPC}
+  other: !Cloudformation {stack: not-in-batch, output: xoxo}
+  ref: !Ref something
+"""
+
+sg_stack = """
+StackName: sg
+TemplateBody: sg.mako
+Parameters:
+  vpc: !Cloudformation {stack: vpc, output: VPC}
+  subnets: [!Cloudformation {stack: subnet, output: a}]
+"""
+
+gcp_stack = """
+stack_type: gcp
+name: vm
+imports:
+  - path: https://my-site.com/vm.jinja
+resources:
+  - properties:
+      network: !GCPDM {project: p, deployment: network, output: vpc}
+"""
+
+
+@pytest.fixture
+def stacks():
+    return [
+        BatchStack("vpc.yaml", vpc_stack),
+        BatchStack("subnet.yaml", subnet_stack),
+        BatchStack("sg.yaml", sg_stack)
+    ]
+
+
+def test_find_stack_files(tmp_path):
+    (tmp_path / "network").mkdir()
+    (tmp_path / "network" / "vpc.mako").write_text("")
+    (tmp_path / "subnet.jinja").write_text("")
+    (tmp_path / "README.md").write_text("")
+
+    assert find_stack_files(str(tmp_path)) == [
+        str(tmp_path / "network" / "vpc.mako"),
+        str(tmp_path / "subnet.jinja")
+    ]
+    assert find_stack_files(str(tmp_path / "*.jinja")) == [
+        str(tmp_path / "subnet.jinja")
+    ]
+    with pytest.raises(SystemExit):
+        find_stack_files(str(tmp_path / "*.json"))
+
+
+def test_batch_stack(stacks):
+    assert stacks[0].name == "vpc"
+    assert stacks[0].dependencies == set()
+    assert stacks[0].templates == ["vpc.mako"]
+    assert stacks[1].dependencies == {"vpc", "not-in-batch"}
+    assert stacks[2].dependencies == {"vpc", "subnet"}
+
+    gcp = BatchStack("vm.mako", gcp_stack)
+    assert gcp.name == "vm"
+    assert gcp.dependencies == {"network"}
+    assert gcp.templates == ["https://my-site.com/vm.jinja"]
+
+
+def test_build_graph(stacks):
+    assert build_graph(stacks) == {
+        "vpc": set(),
+        "subnet": {"vpc"},
+        "sg": {"vpc", "subnet"}
+    }
+    assert build_graph(stacks, reverse=True) == {
+        "vpc": {"subnet", "sg"},
+        "subnet": {"sg"},
+        "sg": set()
+    }
+
+
+def test_build_graph_exceptions(stacks):
+    with pytest.raises(SystemExit):
+        build_graph(stacks + [BatchStack("vpc2.yaml", vpc_stack)])
+
+    cycle = "StackName: vpc\nA: !Cloudformation {stack: sg, output: a}"
+    stacks[0] = BatchStack("vpc.yaml", cycle)
+    with pytest.raises(SystemExit):
+        build_graph(stacks)
+
+
+def test_run_order_and_concurrency():
+    graph = {"a": set(), "b": set(), "c": {"a", "b"}}
+    lock = threading.Lock()
+    started = []
+    finished = []
+    concurrent = []
+
+    def function(name):
+        with lock:
+            started.append(name)
+            concurrent.append(len(started) - len(finished))
+        time.sleep(0.05)
+        with lock:
+            finished.append(name)
+
+    run(graph, function, workers=2)
+    assert started[-1] == "c"
+    assert set(finished[:2]) == {"a", "b"}
+    assert max(concurrent) == 2
+
+
+def test_run_failure_skips_dependents():
+    graph = {"a": set(), "b": {"a"}, "c": set()}
+    executed = []
+
+    def function(name):
+        executed.append(name)
+        if name == "a":
+            raise SystemExit("boom")
+
+    with pytest.raises(SystemExit):
+        run(graph, function, workers=1)
+    assert "b" not in executed
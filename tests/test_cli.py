@@ -1,5 +1,18 @@
+import argparse
+import threading
+import time
+
 import mock
 import pytest
+
+import gpwm.batch
+import gpwm.sessions
+import gpwm.utils
+from gpwm.cli import execute_batch
+from gpwm.cli import execute_stack
+from gpwm.cli import get_region_semaphore
+from gpwm.cli import main
+from gpwm.stacks.aws import CloudformationStack
 from gpwm.cli import resolve_templating_engine
 
 class Stack:
@@ -26,3 +39,253 @@ def test_template_engines(args):
     for engine in engines:
         resolve_templating_engine_local(args, engine)
 
+
+
+def test_execute_batch_validate(tmp_path, mocker):
+    (tmp_path / "vpc.yaml").write_text("StackName: vpc\n")
+    (tmp_path / "subnet.yaml").write_text(
+        "StackName: subnet\n"
+        "Parameters: {vpc: !Cloudformation {stack: vpc, output: VPC}}\n"
+    )
+    run = mocker.patch("gpwm.batch.run")
+    mocker.patch("gpwm.renderers.prefetch_templates")
+    paths = gpwm.batch.find_stack_files(str(tmp_path))
+    args = argparse.Namespace(
+        action="validate",
+        build_id="1",
+        templating_engine="yaml",
+        wait=False,
+        workers=4
+    )
+
+    # validations don't depend on each other, and don't change any stack
+    forget_stack = mocker.patch("gpwm.utils.forget_stack")
+    execute_batch(args, paths)
+    assert run.call_args[0][0] == {"vpc": set(), "subnet": set()}
+    execute = run.call_args[0][1]
+    mocker.patch("gpwm.cli.execute_stack")
+    execute("vpc")
+    forget_stack.assert_not_called()
+
+    args.action = "create"
+    execute_batch(args, paths)
+    assert run.call_args[0][0] == {"vpc": set(), "subnet": {"vpc"}}
+    run.call_args[0][1]("vpc")
+    forget_stack.assert_called_once_with("vpc")
+
+
+def test_execute_stack_regions(mocker):
+    executed = []
+    tags = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def resolve_tags(document):
+        tags.append(gpwm.sessions.get_aws_region())
+        return document
+
+    def execute_action(stack, args, stack_attributes):
+        assert "Regions" not in stack_attributes
+        # both regions run at the same time
+        barrier.wait()
+        executed.append(gpwm.sessions.get_aws_region())
+
+    mocker.patch("gpwm.utils.resolve_tags", side_effect=resolve_tags)
+    factory = mocker.patch("gpwm.stacks.factory")
+    mocker.patch("gpwm.cli.execute_action", side_effect=execute_action)
+    args = argparse.Namespace(
+        action="create",
+        build_id="1",
+        regions=None,
+        region_workers=1
+    )
+    rendered = "StackName: vpc\nRegions: [us-east-1, eu-west-1]\n"
+
+    execute_stack(args, rendered)
+    assert sorted(tags) == sorted(executed) == ["eu-west-1", "us-east-1"]
+    assert factory.call_count == 2
+    assert factory.call_args[1]["BuildId"] == "1"
+
+    # --regions overrides the stack file
+    tags.clear()
+    args.regions = ["ap-south-1"]
+    barrier = threading.Barrier(1)
+    execute_stack(args, rendered)
+    assert tags == ["ap-south-1"]
+
+    with pytest.raises(SystemExit):
+        execute_stack(args, "StackName: vm\nstack_type: gcp\n")
+
+
+def test_render_artifact_and_apply(tmp_path, mocker):
+    stack_file = tmp_path / "vpc.yaml"
+    stack_file.write_text(
+        "StackName: vpc\n"
+        "Regions: [us-east-1, eu-west-1]\n"
+        "TemplateBody: {Resources: {vpc: {Type: AWS::EC2::VPC}}}\n"
+        "Parameters: {cidr: !SSM {Name: /cidr}}\n"
+    )
+    mocker.patch.dict(gpwm.utils.AWS_CALL_CACHE, clear=True)
+    resolve = mocker.patch("botocore.client.BaseClient._make_api_call")
+    resolve.return_value = {"Parameter": {"Value": "10.0.0.0/16"}}
+    artifact = str(tmp_path / "vpc.json")
+    mocker.patch(
+        "sys.argv",
+        ["gpwm", "render", str(stack_file), "-b", "1", "--artifact", artifact]
+    )
+    main()
+    # resolved once per region
+    assert resolve.call_count == 2
+
+    # applying the artifact renders and resolves nothing
+    resolve.reset_mock()
+    regions = []
+    create = mocker.patch.object(
+        CloudformationStack,
+        "create",
+        autospec=True,
+        side_effect=lambda stack, wait: regions.append(
+            (gpwm.sessions.get_aws_region(), stack.Parameters, wait)
+        )
+    )
+    mocker.patch("sys.argv", ["gpwm", "apply", artifact, "-a", "create", "-w"])
+    main()
+    resolve.assert_not_called()
+    assert create.call_count == 2
+    assert sorted(regions) == [
+        ("eu-west-1", {"cidr": "10.0.0.0/16"}, True),
+        ("us-east-1", {"cidr": "10.0.0.0/16"}, True)
+    ]
+
+
+def test_execute_batch_waits_for_dependencies(tmp_path, mocker):
+    (tmp_path / "vpc.yaml").write_text("StackName: vpc\n")
+    (tmp_path / "subnet.yaml").write_text(
+        "StackName: subnet\n"
+        "Parameters: {vpc: !Cloudformation {stack: vpc, output: VPC}}\n"
+    )
+    mocker.patch("gpwm.renderers.prefetch_templates")
+    events = []
+
+    def resolve_tags(document):
+        events.append(f"load {document['StackName']}")
+        return document
+
+    def factory(**kwargs):
+        def create(wait):
+            events.append(f"create {kwargs['StackName']} wait={wait}")
+            if wait:
+                time.sleep(0.05)
+                events.append(f"ready {kwargs['StackName']}")
+        return mock.Mock(create=create)
+
+    mocker.patch("gpwm.utils.resolve_tags", side_effect=resolve_tags)
+    mocker.patch("gpwm.stacks.factory", side_effect=factory)
+    args = argparse.Namespace(
+        action="create",
+        build_id="1",
+        templating_engine="yaml",
+        wait=False,
+        workers=4
+    )
+
+    # no --wait, but subnet can't be loaded before vpc is ready
+    execute_batch(args, gpwm.batch.find_stack_files(str(tmp_path)))
+    assert events == [
+        "load vpc",
+        "create vpc wait=True",
+        "ready vpc",
+        "load subnet",
+        "create subnet wait=False"
+    ]
+
+
+def test_execute_batch_upsert_review(tmp_path, mocker, monkeypatch):
+    (tmp_path / "vpc.yaml").write_text("StackName: vpc\n")
+    mocker.patch("gpwm.renderers.prefetch_templates")
+    factory = mocker.patch("gpwm.stacks.factory")
+    monkeypatch.delenv("GPWM_CHANGE_SET_POLICY", raising=False)
+    paths = gpwm.batch.find_stack_files(str(tmp_path))
+    args = argparse.Namespace(
+        action="upsert",
+        build_id="1",
+        templating_engine="yaml",
+        review=False,
+        wait=False,
+        workers=4
+    )
+
+    # upserts of existing stacks go through change sets, which can't be
+    # prompted for from concurrent workers
+    with pytest.raises(SystemExit):
+        execute_batch(args, paths)
+    factory.assert_not_called()
+
+    monkeypatch.setenv("GPWM_CHANGE_SET_POLICY", "execute")
+    execute_batch(args, paths)
+    factory().upsert.assert_called_once_with(wait=False)
+
+
+def test_execute_stack_regions_tags(mocker):
+    mocker.patch("gpwm.cli.execute_action")
+    args = argparse.Namespace(
+        action="create",
+        build_id="1",
+        regions=["us-east-1", "eu-west-1", "ap-south-1"],
+        region_workers=4
+    )
+    rendered = (
+        "StackName: vpc\n"
+        "TemplateBody: {Resources: {}}\n"
+        "Tags: [{Key: team, Value: network}]\n"
+    )
+
+    stack_type, stacks = execute_stack(args, rendered)
+    assert len(stacks) == 3
+    for region, stack in stacks:
+        assert stack.Tags == [
+            {"Key": "team", "Value": "network"},
+            {"Key": "build_id", "Value": "1"}
+        ]
+
+
+def test_execute_stack_regions_scalar(mocker):
+    mocker.patch("gpwm.cli.execute_action")
+    mocker.patch("gpwm.stacks.factory")
+    args = argparse.Namespace(action="create", build_id="1", region_workers=4)
+
+    rendered = "StackName: vpc\nRegions: eu-west-1\n"
+    stack_type, stacks = execute_stack(args, rendered)
+    assert [region for region, stack in stacks] == ["eu-west-1"]
+
+    with pytest.raises(SystemExit):
+        execute_stack(args, "StackName: vpc\nRegions: {a: b}\n")
+
+
+def test_get_region_semaphore():
+    semaphore = get_region_semaphore("us-east-1", 1)
+    assert get_region_semaphore("us-east-1", 1) is semaphore
+    # a different cap gets its own semaphore
+    semaphore = get_region_semaphore("us-east-1", 2)
+    assert semaphore.acquire(blocking=False)
+    assert semaphore.acquire(blocking=False)
+    assert not semaphore.acquire(blocking=False)
+    semaphore.release()
+    semaphore.release()
+
+
+def test_execute_batch_duplicate_stacks(tmp_path, mocker):
+    (tmp_path / "one.yaml").write_text("StackName: a\n")
+    (tmp_path / "two.yaml").write_text("StackName: a\n")
+    run = mocker.patch("gpwm.batch.run")
+    mocker.patch("gpwm.renderers.prefetch_templates")
+    args = argparse.Namespace(
+        action="create",
+        build_id="1",
+        templating_engine="yaml",
+        wait=False,
+        workers=4
+    )
+
+    with pytest.raises(SystemExit, match="Duplicate stack in batch: a"):
+        execute_batch(args, gpwm.batch.find_stack_files(str(tmp_path)))
+    run.assert_not_called()
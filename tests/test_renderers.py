@@ -1,3 +1,4 @@
+import io
 import json
 import os
 import requests
@@ -7,12 +8,17 @@ from unittest.mock import patch
 import yaml
 
 import pytest
+from botocore.exceptions import ClientError
 
+import gpwm.utils
+from gpwm.renderers import get_jinja_template
+from gpwm.renderers import get_mako_template
 from gpwm.renderers import get_template_body
 from gpwm.renderers import parse_json
 from gpwm.renderers import parse_jinja
 from gpwm.renderers import parse_mako
 from gpwm.renderers import parse_yaml
+from gpwm.renderers import prefetch_templates
 
 mako_template = """
 <%
@@ -62,6 +68,10 @@ expected_parsed_dict = {
 
 parameters = {"p1": "p11", "p2": "p22"}
 
+dumpable_tags = """
+  d: !Join ["-", [!Ref a, {b: !GetAtt b.Arn}]]
+"""
+
 
 def test_get_template_body_local_file():
     url = "examples/consumables/aws/network/vpc.mako"
@@ -72,10 +82,12 @@ def test_get_template_body_local_file():
 
 def test_get_template_body_http(mocker):
     url = "https://my-site.com/vpc.mako"
-    mock_req = mocker.patch("requests.get")
+    mock_req = mocker.patch("gpwm.renderers.get_http_session").return_value.get
     mock_resp = mocker.MagicMock()
     mock_req.return_value = mock_resp
     mock_resp.text = "somedata"
+    mock_resp.status_code = 200
+    mock_resp.headers = {}
 
     parsed_url, body = get_template_body(url)
     assert parsed_url.scheme == "https"
@@ -88,12 +100,14 @@ def test_get_template_body_s3(mocker):
     url = f"s3://{bucket}/{filename}"
     content = "somedata"
 
-    mock_boto = mocker.patch("gpwm.renderers.boto3")
-    mock_boto.resource.return_value.Object.return_value.get.return_value.__getitem__.return_value.read.return_value = content # noqa
+    mock_s3 = mocker.patch("gpwm.renderers.get_s3_client").return_value
+    mock_s3.get_object.return_value = {
+        "Body": io.BytesIO(content.encode()),
+        "ETag": '"abc"'
+    }
     parsed_url, body = get_template_body(url)
 
-    mock_boto.resource.assert_called_with("s3")
-    mock_boto.resource().Object.assert_called_with(bucket, filename)
+    mock_s3.get_object.assert_called_with(Bucket=bucket, Key=filename)
     assert parsed_url.scheme == "s3"
     assert body == content
 
@@ -102,20 +116,90 @@ def test_get_template_use_prefix(mocker):
     url = "vpc.mako"
     prefix = "https://my-site.com"
     mocker.patch.dict('os.environ', {"GPWM_TEMPLATE_URL_PREFIX": prefix})
-    mock_req = mocker.patch("requests.get")
+    mock_req = mocker.patch("gpwm.renderers.get_http_session").return_value.get
     mock_resp = mocker.MagicMock()
     mock_req.return_value = mock_resp
     mock_resp.text = "somedata"
+    mock_resp.status_code = 200
+    mock_resp.headers = {}
 
     parsed_url, body = get_template_body(url)
     assert parsed_url.scheme == "https"
     assert body == "somedata"
-    mock_req.assert_called_with(f"{prefix}/{url}")
+    mock_req.assert_called_with(f"{prefix}/{url}", headers={})
+
+
+def test_get_template_body_http_cache(mocker, monkeypatch):
+    url = "https://my-site.com/vpc.mako"
+    mock_req = mocker.patch("gpwm.renderers.get_http_session").return_value.get
+    mock_req.return_value.status_code = 200
+    mock_req.return_value.text = "somedata"
+    mock_req.return_value.headers = {"ETag": '"abc"'}
+    get_template_body(url)
+
+    # revalidated with the ETag, and not modified
+    mock_req.return_value.status_code = 304
+    mock_req.return_value.text = ""
+    parsed_url, body = get_template_body(url)
+    assert body == "somedata"
+    mock_req.assert_called_with(url, headers={"If-None-Match": '"abc"'})
+
+    # not revalidated within the TTL
+    monkeypatch.setenv("GPWM_TEMPLATE_CACHE_TTL", "60")
+    mock_req.reset_mock()
+    assert get_template_body(url)[1] == "somedata"
+    mock_req.assert_not_called()
+
+    # offline mode only uses the cache
+    monkeypatch.setenv("GPWM_TEMPLATE_CACHE_TTL", "0")
+    monkeypatch.setenv("GPWM_OFFLINE", "1")
+    assert get_template_body(url)[1] == "somedata"
+    mock_req.assert_not_called()
+    with pytest.raises(SystemExit):
+        get_template_body("https://my-site.com/other.mako")
+
+
+def test_get_template_body_s3_cache(mocker):
+    url = "s3://my-bucket/vpc.mako"
+    mock_s3 = mocker.patch("gpwm.renderers.get_s3_client").return_value
+    mock_s3.exceptions.NoSuchBucket = KeyError
+    mock_s3.exceptions.NoSuchKey = KeyError
+    mock_get = mock_s3.get_object
+    mock_get.return_value = {"Body": io.BytesIO(b"somedata"), "ETag": '"abc"'}
+    get_template_body(url)
+
+    error = {"Error": {"Code": "304", "Message": "Not Modified"}}
+    mock_get.side_effect = ClientError(error, "GetObject")
+    assert get_template_body(url)[1] == "somedata"
+    mock_get.assert_called_with(
+        Bucket="my-bucket",
+        Key="vpc.mako",
+        IfNoneMatch='"abc"'
+    )
+
+
+def test_prefetch_templates(mocker):
+    mock_fetch = mocker.patch("gpwm.renderers.get_remote_template_body")
+    mock_fetch.side_effect = lambda url, parsed_url: f"body of {url}"
+    mocker.patch.dict("gpwm.renderers.PREFETCHED_TEMPLATES", clear=True)
+    urls = [
+        "https://my-site.com/vpc.mako",
+        "https://my-site.com/vpc.mako",
+        "s3://my-bucket/subnet.mako",
+        "examples/consumables/aws/network/vpc.mako"
+    ]
+
+    prefetch_templates(urls, workers=2)
+    assert mock_fetch.call_count == 2
+
+    parsed_url, body = get_template_body("s3://my-bucket/subnet.mako")
+    assert body == "body of s3://my-bucket/subnet.mako"
+    assert mock_fetch.call_count == 2
 
 
 def test_get_template_body_http_exception(mocker):
     url = "https://my-site.com/vpc.mako"
-    mock_req = mocker.patch("requests.get")
+    mock_req = mocker.patch("gpwm.renderers.get_http_session").return_value.get
     mock_req.side_effect = requests.exceptions.RequestException()
     with pytest.raises(SystemExit):
         parsed_url, body = get_template_body(url)
@@ -127,11 +211,11 @@ def test_get_template_body_s3_exception(mocker):
     url = f"s3://{bucket}/{filename}"
     content = "somedata"
 
-    mock_boto = mocker.patch("gpwm.renderers.boto3")
+    mock_resource = mocker.patch("gpwm.renderers.get_s3_client")
 #    mock_boto.meta.return_value.client.return_value.exceptions.return_value.NoSuchBucket.return_value = Exception()  # noqa
-    mock_boto.resource.return_value.Object.return_value.get.side_effect = mock_boto.meta.client.exceptions.NoSuchBucket  # noqa
-    print(mock_boto.meta.client.exceptions.NoSuchBucket)
-    print(mock_boto.resource("s3").Object(bucket, filename).get())
+    mock_resource.return_value.Object.return_value.get.side_effect = mock_resource.meta.client.exceptions.NoSuchBucket  # noqa
+    print(mock_resource.meta.client.exceptions.NoSuchBucket)
+    print(mock_resource("s3").Object(bucket, filename).get())
 #    get_template_body(url)
 #    mock_boto.resource.return_value.Object.return_value.get.return_value.__getitem__.return_value.read.side_effect = "s3.meta.client.exceptions.NoSuchBucket  # noqa
 #    mock_bucket_exc = mocker.patch(
@@ -158,13 +242,28 @@ def test_parse_mako(mocker):
     mock_engine = mocker.patch("gpwm.renderers.mako.template.Template")
     mock_engine.render.return_value = rendered_template
 
-    mock_yaml = mocker.patch("gpwm.renderers.yaml")
-    mock_yaml.load.return_value = expected_resources_dict
+    mock_load = mocker.patch("gpwm.utils.load_yaml")
+    mock_load.return_value = expected_resources_dict
 
     parse_mako(stack_name, mako_template, parameters)
-    mock_engine.assert_called_once_with(mako_template, strict_undefined=False)
+    mock_engine.assert_called_once()
+    assert mock_engine.call_args[1]["strict_undefined"] is False
     mock_engine().render.assert_called_once_with(**parameters)
-    mock_yaml.load.assert_called_once_with(mock_engine().render())
+    mock_load.assert_called_once_with(mock_engine().render())
+
+
+def test_get_mako_template_cache(cache_dir, monkeypatch):
+    template = get_mako_template(mako_template, strict_undefined=False)
+    assert template.render() == get_mako_template(mako_template).render()
+
+    modules = list(cache_dir.glob("mako/*/modules/*.py"))
+    assert len(modules) == 2
+    mtimes = [m.stat().st_mtime_ns for m in modules]
+    get_mako_template(mako_template, strict_undefined=False)
+    assert [m.stat().st_mtime_ns for m in modules] == mtimes
+
+    monkeypatch.setenv("GPWM_NO_CACHE", "1")
+    assert get_mako_template(mako_template).filename is None
 
 
 def test_parse_mako_exceptions():
@@ -181,7 +280,7 @@ def test_parse_mako_exceptions():
             parse_mako(stack_name, mako_template, parameters)
 
     # test catching yaml loading exception
-    with patch("gpwm.renderers.yaml.load") as mock_yaml:
+    with patch("gpwm.utils.load_yaml") as mock_yaml:
         exc = yaml.constructor.ConstructorError(None, None, "random_exception")
         mock_yaml.side_effect = exc
 
@@ -196,23 +295,39 @@ def test_parse_jinja(mocker):
     # handling yaml node objects in a dict
     assert yaml.dump(parsed_template) == yaml.dump(expected_parsed_dict)
 
-    mock_engine = mocker.patch("gpwm.renderers.jinja2.Template")
+    mock_engine = mocker.patch("gpwm.renderers.get_jinja_template")
     mock_engine.render.return_value = rendered_template
 
-    mock_yaml = mocker.patch("gpwm.renderers.yaml")
-    mock_yaml.load.return_value = expected_resources_dict
+    mock_load = mocker.patch("gpwm.utils.load_yaml")
+    mock_load.return_value = expected_resources_dict
 
     parse_jinja(stack_name, jinja_template, parameters)
     mock_engine.assert_called_once_with(jinja_template)
     mock_engine().render.assert_called_once_with(**parameters)
-    mock_yaml.load.assert_called_once_with(mock_engine().render())
+    mock_load.assert_called_once_with(mock_engine().render())
+
+
+def test_get_jinja_template_cache(cache_dir, mocker):
+    template = get_jinja_template(jinja_template)
+    assert len(list(cache_dir.glob("jinja/*/*.cache"))) == 1
+
+    compile = mocker.spy(template.environment, "compile")
+    assert get_jinja_template(jinja_template).render() == template.render()
+    compile.assert_not_called()
+
+
+def test_get_jinja_template_include(tmp_path):
+    include = tmp_path / "resources.jinja"
+    include.write_text("{% for r in resources %}{{r}}: 1\n{% endfor %}")
+    template = get_jinja_template("{% include '" + str(include) + "' %}")
+    assert yaml.load(template.render(resources=["a", "b"])) == {"a": 1, "b": 1}
 
 
 def test_parse_jinja_exceptions():
     stack_name = "my-stack"
 
     # test catching yaml loading exception
-    with patch("gpwm.renderers.yaml.load") as mock_yaml:
+    with patch("gpwm.utils.load_yaml") as mock_yaml:
         exc = yaml.constructor.ConstructorError(None, None, "random_exception")
         mock_yaml.side_effect = exc
 
@@ -220,6 +335,22 @@ def test_parse_jinja_exceptions():
             parse_jinja(stack_name, mako_template, parameters)
 
 
+def test_parse_mako_libyaml():
+    template = parse_mako("my-stack", mako_template + dumpable_tags, {})
+    # provider tags survive a round trip through the dumper and loader
+    dumped = gpwm.utils.dump_yaml(template)
+    resources = gpwm.utils.load_yaml(dumped)["Resources"]
+    assert (resources["a"], resources["b"]) == (1, 2)
+    assert (resources["c"].tag, resources["c"].value) == \
+        ("!CloudProviderTag", "tag-value")
+    assert resources["d"].tag == "!Join"
+    ref = resources["d"].value[1].value[0]
+    assert (ref.tag, ref.value) == ("!Ref", "a")
+    if yaml.__with_libyaml__:
+        assert issubclass(gpwm.utils.Loader, yaml.CSafeLoader)
+        assert issubclass(gpwm.utils.Dumper, yaml.CDumper)
+
+
 def test_parse_yaml():
     with pytest.raises(SystemExit):
         parse_yaml("my-stack", rendered_template, parameters)
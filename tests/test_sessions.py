@@ -0,0 +1,153 @@
+import collections
+import concurrent.futures
+import types
+
+import pytest
+
+from gpwm.sessions import AWS
+from gpwm.sessions import AWSClients
+from gpwm.sessions import AzureClient
+from gpwm.sessions import aws_region
+from gpwm.sessions import get_aws_region
+
+
+@pytest.fixture
+def azure(mocker, monkeypatch):
+    mocker.patch.dict(AzureClient.__CACHE__, clear=True)
+    mocker.patch.dict(AzureClient.__SUBSCRIPTIONS__, clear=True)
+    for name in ["AZURE_CLIENT_ID", "AZURE_CLIENT_SECRET", "AZURE_TENANT_ID",
+                 "AZURE_AUTH_LOCATION", "GPWM_AZURE_SUBSCRIPTION_CACHE_TTL"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("AZURE_SUBSCRIPTION", "dev")
+    get_client = mocker.patch("gpwm.sessions.get_azure_api_client")
+    subscriptions = [
+        types.SimpleNamespace(display_name="dev", subscription_id="id-dev"),
+        types.SimpleNamespace(display_name="prod", subscription_id="id-prod")
+    ]
+    list_subscriptions = mocker.MagicMock(return_value=subscriptions)
+    get_client.side_effect = lambda cls, **kwargs: (
+        mocker.MagicMock(**{"subscriptions.list": list_subscriptions})
+        if cls.__name__ == "SubscriptionClient"
+        else mocker.MagicMock(kwargs=kwargs)
+    )
+    return list_subscriptions
+
+
+def test_azure_client_cache(azure):
+    client = AzureClient().get("resource.ResourceManagementClient")
+    assert client.kwargs == {"subscription_id": "id-dev"}
+    assert AzureClient().get("resource.ResourceManagementClient") is client
+
+    prod = AzureClient().get(
+        "resource.ResourceManagementClient",
+        subscription="prod"
+    )
+    assert prod is not client
+    assert prod.kwargs == {"subscription_id": "id-prod"}
+    azure.assert_called_once()
+
+    with pytest.raises(SystemExit):
+        AzureClient().get(
+            "resource.ResourceManagementClient",
+            subscription="x"
+        )
+
+
+def test_azure_subscription_disk_cache(azure, monkeypatch):
+    monkeypatch.setenv("GPWM_AZURE_SUBSCRIPTION_CACHE_TTL", "3600")
+    AzureClient().get("resource.ResourceManagementClient")
+    AzureClient.__CACHE__.clear()
+    AzureClient.__SUBSCRIPTIONS__.clear()
+    client = AzureClient().get("resource.ResourceManagementClient")
+    assert client.kwargs == {"subscription_id": "id-dev"}
+    azure.assert_called_once()
+
+
+def test_azure_credentials_built_once(azure, mocker, monkeypatch):
+    mocker.patch.dict(AzureClient.__CREDENTIALS__, clear=True)
+    monkeypatch.setenv("AZURE_CLIENT_ID", "client")
+    monkeypatch.setenv("AZURE_CLIENT_SECRET", "secret")
+    monkeypatch.setenv("AZURE_TENANT_ID", "tenant")
+    # building credentials fetches a token from Azure AD
+    credentials = mocker.patch(
+        "azure.common.credentials.ServicePrincipalCredentials"
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(
+            lambda i: AzureClient().get("resource.ResourceManagementClient"),
+            range(16)
+        ))
+    assert all(c is clients[0] for c in clients)
+    assert clients[0].kwargs == {
+        "credentials": credentials.return_value,
+        "subscription_id": "id-dev"
+    }
+    credentials.assert_called_once_with(
+        client_id="client",
+        secret="secret",
+        tenant="tenant"
+    )
+    azure.assert_called_once()
+
+    # cached clients don't need credentials at all
+    credentials.reset_mock()
+    AzureClient.__CREDENTIALS__.clear()
+    AzureClient().get("resource.ResourceManagementClient")
+    credentials.assert_not_called()
+
+
+@pytest.fixture
+def aws_clients(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    monkeypatch.setattr(AWSClients, "__CLIENTS__", {})
+    monkeypatch.setattr(AWSClients, "__SESSIONS__", {})
+    monkeypatch.setattr(AWSClients, "stats", collections.Counter())
+    return AWSClients()
+
+
+def test_aws_clients(aws_clients):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(lambda i: aws_clients.get("ssm"), range(16)))
+    assert all(c is clients[0] for c in clients)
+    assert aws_clients.stats["clients_created"] == 1
+    assert aws_clients.stats["clients_reused"] == 15
+
+    east = aws_clients.get("ssm", region="us-east-1")
+    assert east is not clients[0]
+    assert east.meta.region_name == "us-east-1"
+    assert AWS().client is AWS().client
+    assert AWS().client.meta.service_model.service_name == "cloudformation"
+    assert aws_clients.stats["clients_created"] == 3
+
+
+def test_aws_region(aws_clients):
+    default = aws_clients.get("ssm")
+    with aws_region("eu-west-1"):
+        assert get_aws_region() == "eu-west-1"
+        west = aws_clients.get("ssm")
+        assert west.meta.region_name == "eu-west-1"
+        assert AWS().client.meta.region_name == "eu-west-1"
+        # other threads keep their own region
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            assert pool.submit(aws_clients.get, "ssm").result() is default
+    assert get_aws_region() is None
+    assert aws_clients.get("ssm") is default
+    assert aws_clients.get("ssm", region="eu-west-1") is west
+
+
+def test_call_aws_reuses_clients(aws_clients, mocker):
+    import gpwm.utils
+    make_api_call = mocker.patch("botocore.client.BaseClient._make_api_call")
+    make_api_call.return_value = {"Parameter": {"Value": "v"}}
+    for i in range(3):
+        gpwm.utils.call_aws(
+            "ssm",
+            "get_parameter",
+            {"Name": "/a"},
+            "Parameter.Value"
+        )
+    assert aws_clients.stats["clients_created"] == 1
+    assert aws_clients.stats["clients_reused"] == 2
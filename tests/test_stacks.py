@@ -1,7 +1,18 @@
+import datetime
+import http.server
+import json
+import threading
+
+from botocore.exceptions import ClientError
 import mock
 import pytest
 import gpwm.stacks
+import gpwm.stacks.aws
+import gpwm.utils
 from gpwm.stacks.aws import CloudformationStack
+import gpwm.renderers
+from gpwm.sessions import AWSClients
+from gpwm.sessions import aws_region
 
 #@pytest.fixture
 #def args():
@@ -22,3 +33,417 @@ def test_aws(aws_stack):
 
     assert isinstance(stack, CloudformationStack)
 
+
+
+def test_aws_template_serialized_once(aws_stack1, mocker, monkeypatch):
+    stack = gpwm.stacks.factory(**aws_stack1)
+    assert isinstance(stack.TemplateBody, dict)
+
+    dump_yaml = mocker.spy(gpwm.utils, "dump_yaml")
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    stack.create()
+    dump_yaml.assert_called_once()
+    template_body = session().resource.create_stack.call_args[1][
+        "TemplateBody"
+    ]
+    session().client.validate_template.assert_called_once_with(
+        TemplateBody=template_body
+    )
+    assert gpwm.utils.load_yaml(template_body) == gpwm.utils.load_yaml(
+        gpwm.utils.dump_yaml(stack.TemplateBody)
+    )
+    assert "_template_body" not in session().resource.create_stack.call_args[1]
+
+    monkeypatch.setenv("GPWM_TEMPLATE_FORMAT", "json")
+    template = json.loads(stack.get_template_body())
+    assert template["Resources"]["VPC"]["Properties"]["CidrBlock"] == \
+        "10.0.0.0/16"
+
+
+class S3StandIn(http.server.BaseHTTPRequestHandler):
+    """ A minimal local S3: HEAD and PUT of path-style objects, and the
+    location of buckets """
+    objects = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path))
+        body = (
+            '<LocationConstraint xmlns="http://s3.amazonaws.com/doc/'
+            '2006-03-01/">eu-west-1</LocationConstraint>'
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.requests.append(("HEAD", self.path))
+        self.send_response(200 if self.path in self.objects else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        self.requests.append(("PUT", self.path))
+        length = int(self.headers["Content-Length"])
+        self.objects[self.path] = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("ETag", '"etag"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def s3_stand_in(monkeypatch):
+    S3StandIn.objects = {}
+    S3StandIn.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), S3StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setenv("AWS_ENDPOINT_URL_S3", endpoint)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    monkeypatch.setenv("GPWM_HTTP_RETRIES", "0")
+    monkeypatch.setattr(AWSClients, "__CLIENTS__", {})
+    monkeypatch.setattr(AWSClients, "__SESSIONS__", {})
+    monkeypatch.setattr(gpwm.stacks.aws, "BUCKET_REGIONS", {})
+    yield endpoint
+    server.shutdown()
+    server.server_close()
+
+
+def test_aws_template_url(aws_stack1, mocker, monkeypatch, s3_stand_in):
+    monkeypatch.setenv("GPWM_TEMPLATE_BUCKET", "my-bucket/cfn")
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    stack = gpwm.stacks.factory(**aws_stack1)
+    assert "TemplateBody" in stack.get_template_args()
+    assert not S3StandIn.requests
+
+    stack = gpwm.stacks.factory(**aws_stack1)
+    stack.TemplateBody["Description"] = "x" * 60000
+    # deployed to another region than the bucket's
+    with aws_region("ap-south-1"):
+        stack.update(review=False)
+    api_args = session().resource.Stack().update.call_args[1]
+    assert "TemplateBody" not in api_args
+    url = api_args["TemplateURL"]
+    assert url.startswith(f"{s3_stand_in}/my-bucket/cfn/")
+    session().client.validate_template.assert_called_once_with(
+        TemplateURL=url
+    )
+    assert S3StandIn.requests == [
+        ("GET", "/my-bucket?location"),
+        ("HEAD", url[len(s3_stand_in):]),
+        ("PUT", url[len(s3_stand_in):])
+    ]
+    # uploaded by a client of the bucket's region
+    assert ("client", "s3", "eu-west-1", None) in AWSClients.__CLIENTS__
+
+    # same template, another run: only a HEAD request
+    S3StandIn.requests.clear()
+    stack = gpwm.stacks.factory(**aws_stack1)
+    stack.TemplateBody["Description"] = "x" * 60000
+    assert stack.get_template_args() == {"TemplateURL": url}
+    assert S3StandIn.requests == [("HEAD", url[len(s3_stand_in):])]
+
+
+def test_aws_template_too_large(aws_stack1, monkeypatch):
+    monkeypatch.delenv("GPWM_TEMPLATE_BUCKET", raising=False)
+    stack = gpwm.stacks.factory(**aws_stack1)
+    stack.TemplateBody["Description"] = "x" * 60000
+    with pytest.raises(SystemExit):
+        stack.get_template_args()
+
+
+def test_aws_skip_up_to_date(aws_stack1, mocker, monkeypatch):
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    stack = gpwm.stacks.factory(**aws_stack1)
+    fingerprint = stack.get_fingerprint()
+    tags = stack.get_api_args()["Tags"]
+    assert {"Key": "gpwm_fingerprint", "Value": fingerprint} in tags
+    session().client.describe_stacks.return_value = {"Stacks": [{
+        "StackStatus": "UPDATE_COMPLETE",
+        "Tags": tags
+    }]}
+
+    # a new build of the same stack is a no-op
+    stack = gpwm.stacks.factory(**dict(aws_stack1, BuildId=2))
+    assert stack.get_fingerprint() == fingerprint
+    stack.update(review=False)
+    session().client.validate_template.assert_not_called()
+    session().resource.Stack().update.assert_not_called()
+
+    monkeypatch.setenv("GPWM_FORCE_UPDATE", "1")
+    stack.update(review=False)
+    session().resource.Stack().update.assert_called_once()
+    monkeypatch.delenv("GPWM_FORCE_UPDATE")
+
+    parameters = dict(aws_stack1["Parameters"], cidr="10.1.0.0/16")
+    stack = gpwm.stacks.factory(**dict(aws_stack1, Parameters=parameters))
+    assert stack.get_fingerprint() != fingerprint
+    stack.update(review=False)
+    assert session().resource.Stack().update.call_count == 2
+
+
+def test_gcp_skip_up_to_date(mocker):
+    import gpwm.stacks.gcp
+    session = mocker.patch("gpwm.stacks.gcp.GCPSession")
+    deployment = {
+        "project": "p",
+        "name": "vm",
+        "resources": [{"name": "vm", "type": "compute.v1.instance"}],
+        "labels": {"team": "compute"}
+    }
+    stack = gpwm.stacks.gcp.GCPStack(BuildId=1, **deployment)
+    session().client.deployments().get().execute.return_value = {
+        "labels": stack.body["labels"],
+        "operation": {"status": "DONE"}
+    }
+    update = session().client.deployments().update
+
+    stack = gpwm.stacks.gcp.GCPStack(BuildId=2, **deployment)
+    stack.upsert()
+    update.assert_not_called()
+
+    deployment["labels"] = {"team": "network"}
+    stack = gpwm.stacks.gcp.GCPStack(BuildId=2, **deployment)
+    stack.upsert()
+    update.assert_called_once()
+
+
+def stack_event(event_id, status, resource="my-stack", reason=None):
+    event = {
+        "EventId": event_id,
+        "StackName": "my-stack",
+        "LogicalResourceId": resource,
+        "ResourceType": "AWS::CloudFormation::Stack",
+        "ResourceStatus": status,
+        "Timestamp": datetime.datetime(2018, 1, 1)
+    }
+    if resource != "my-stack":
+        event["ResourceType"] = "AWS::EC2::VPC"
+    if reason:
+        event["ResourceStatusReason"] = reason
+    return event
+
+
+def test_aws_wait(aws_stack1, mocker, capsys):
+    sleep = mocker.patch("gpwm.stacks.aws.time.sleep")
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    old = stack_event("0", "CREATE_COMPLETE")
+    session().client.describe_stack_events.side_effect = [
+        {"StackEvents": [old]},
+        {"StackEvents": [old]},
+        {"StackEvents": [
+            stack_event("2", "CREATE_COMPLETE", "VPC"),
+            stack_event("1", "UPDATE_IN_PROGRESS"),
+            old
+        ]},
+        {"StackEvents": [
+            stack_event("3", "UPDATE_COMPLETE"),
+            stack_event("2", "CREATE_COMPLETE", "VPC")
+        ]},
+    ]
+    stack = gpwm.stacks.factory(**aws_stack1)
+    mocker.patch.object(
+        CloudformationStack, "is_up_to_date", return_value=False
+    )
+    stack.update(wait=True, review=False)
+
+    # backs off while nothing happens, and is fast again after events
+    intervals = [c[0][0] for c in sleep.call_args_list]
+    assert intervals == [1, 1.5, 1]
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[2] for line in lines] == [
+        "UPDATE_IN_PROGRESS",
+        "CREATE_COMPLETE",
+        "UPDATE_COMPLETE"
+    ]
+
+
+def test_aws_wait_failure(aws_stack1, mocker):
+    mocker.patch("gpwm.stacks.aws.time.sleep")
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    session().client.describe_stack_events.return_value = {"StackEvents": [
+        stack_event("3", "ROLLBACK_COMPLETE"),
+        stack_event("2", "CREATE_FAILED", "VPC", "Invalid CIDR"),
+        stack_event("1", "CREATE_IN_PROGRESS")
+    ]}
+    stack = gpwm.stacks.factory(**aws_stack1)
+    with pytest.raises(SystemExit, match="ROLLBACK_COMPLETE: Invalid CIDR"):
+        stack.create(wait=True)
+
+    # deleted stacks can't be described
+    session().client.describe_stack_events.side_effect = ClientError(
+        {"Error": {"Code": "ValidationError", "Message": "does not exist"}},
+        "DescribeStackEvents"
+    )
+    stack.wait("delete", last_event_id="3")
+
+
+def test_gcp_wait(mocker, capsys):
+    import gpwm.stacks.gcp
+    sleep = mocker.patch("gpwm.stacks.gcp.time.sleep")
+    mocker.patch("gpwm.stacks.gcp.random.uniform", return_value=1)
+    session = mocker.patch("gpwm.stacks.gcp.GCPSession")
+    get_operation = session().client.operations().get().execute
+    get_operation.side_effect = [
+        {"name": "op-1", "status": "RUNNING", "progress": 0},
+        {"name": "op-1", "status": "RUNNING", "progress": 0},
+        {"name": "op-1", "status": "RUNNING", "progress": 50},
+        {"name": "op-1", "status": "DONE", "progress": 100}
+    ]
+    stack = gpwm.stacks.gcp.GCPStack(BuildId=1, project="p", name="vm")
+    stack.wait({"name": "op-1", "status": "PENDING"})
+    assert [c[0][0] for c in sleep.call_args_list] == [1, 2, 4, 8]
+    assert len(capsys.readouterr().out.splitlines()) == 3
+
+    get_operation.side_effect = [{
+        "name": "op-2",
+        "status": "DONE",
+        "error": {"errors": [{"code": "QUOTA", "message": "No CPUs left"}]}
+    }]
+    with pytest.raises(SystemExit, match="QUOTA: No CPUs left"):
+        stack.wait({"name": "op-2", "status": "PENDING"})
+
+    get_operation.side_effect = None
+    get_operation.return_value = {"name": "op-3", "status": "RUNNING"}
+    with pytest.raises(SystemExit, match="Timed out"):
+        stack.wait({"name": "op-3", "status": "PENDING"}, timeout=0)
+
+
+def change_set(*replacements, status="CREATE_COMPLETE", **kwargs):
+    return dict(kwargs, Status=status, Changes=[
+        {"ResourceChange": {"LogicalResourceId": r, "Replacement": "True"}}
+        for r in replacements
+    ])
+
+
+@pytest.mark.parametrize("policy, replacements, executed", [
+    ("execute", ["VPC"], True),
+    ("keep", [], False),
+    ("delete", [], False),
+    ("execute-unless-replacement", [], True),
+    ("execute-unless-replacement", ["VPC"], False),
+])
+def test_aws_change_set_policy(
+        aws_stack1, mocker, monkeypatch, policy, replacements, executed):
+    monkeypatch.setenv("GPWM_CHANGE_SET_POLICY", policy)
+    sleep = mocker.patch("gpwm.stacks.aws.time.sleep")
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    client = session().client
+    client.describe_change_set.side_effect = [
+        change_set(status="CREATE_PENDING"),
+        change_set(status="CREATE_IN_PROGRESS"),
+        change_set(*replacements[:1], NextToken="2"),
+        change_set(*replacements[1:])
+    ]
+    stack = gpwm.stacks.factory(**aws_stack1)
+    stack.manage_change_set()
+    assert [c[0][0] for c in sleep.call_args_list] == [1, 1.5]
+    assert client.execute_change_set.called == executed
+    assert client.delete_change_set.called == (policy == "delete")
+
+
+def test_aws_change_set_no_changes(aws_stack1, mocker, monkeypatch):
+    monkeypatch.delenv("GPWM_CHANGE_SET_POLICY", raising=False)
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    client = session().client
+    client.describe_change_set.return_value = change_set(
+        status="FAILED",
+        StatusReason="The submitted information didn't contain changes."
+    )
+    mocker.patch("gpwm.stacks.aws.input", side_effect=AssertionError)
+    stack = gpwm.stacks.factory(**aws_stack1)
+    stack.manage_change_set()
+    client.delete_change_set.assert_called_once()
+    client.execute_change_set.assert_not_called()
+
+    client.describe_change_set.return_value = change_set(
+        status="FAILED",
+        StatusReason="Access denied"
+    )
+    with pytest.raises(SystemExit, match="Access denied"):
+        stack.manage_change_set()
+
+
+def test_aws_validate_cache(aws_stack1, mocker):
+    session = mocker.patch("gpwm.stacks.aws.AWSSession")
+    session().client.meta.region_name = "us-west-2"
+    gpwm.stacks.factory(**aws_stack1).validate()
+    gpwm.stacks.factory(**dict(aws_stack1, BuildId=2)).validate()
+    session().client.validate_template.assert_called_once()
+
+    session().client.meta.region_name = "us-east-1"
+    gpwm.stacks.factory(**aws_stack1).validate()
+    assert session().client.validate_template.call_count == 2
+
+    # failed validations aren't cached
+    session().client.validate_template.side_effect = ClientError(
+        {"Error": {"Code": "ValidationError", "Message": "invalid"}},
+        "ValidateTemplate"
+    )
+    parameters = dict(aws_stack1["Parameters"], cidr="10.1.0.0/16")
+    stack = gpwm.stacks.factory(**dict(aws_stack1, Parameters=parameters))
+    for i in range(2):
+        with pytest.raises(SystemExit, match="invalid"):
+            stack.validate()
+    assert session().client.validate_template.call_count == 4
+
+
+def test_azure_shared_resource_group(mocker):
+    import types
+    import gpwm.stacks.azure
+    api_client = mocker.patch("gpwm.stacks.azure.AzureClient")().get()
+    group = {"tags": {}}
+
+    def set_tags(name, parameters):
+        # like the API, create_or_update() and update() replace the tags
+        group["tags"] = dict(parameters.get("tags") or {})
+        return types.SimpleNamespace(tags=dict(group["tags"]))
+
+    api_client.resource_groups.get.side_effect = \
+        lambda name: types.SimpleNamespace(tags=dict(group["tags"]))
+    api_client.resource_groups.create_or_update.side_effect = set_tags
+    api_client.resource_groups.update.side_effect = set_tags
+    api_client.deployments.get().properties.provisioning_state = "Succeeded"
+
+    def deployment(name):
+        return gpwm.stacks.azure.AzureStack(
+            name=name,
+            BuildId="1",
+            resourceGroup={
+                "name": "rg",
+                "location": "eastus",
+                "tags": {"team": "network"}
+            },
+            template={"resources": [name]},
+            mode="incremental"
+        )
+
+    a, b = deployment("a"), deployment("b")
+    a.upsert()
+    b.upsert()
+    assert group["tags"] == {
+        "team": "network",
+        "gpwm_fingerprint_a": a.fingerprint,
+        "gpwm_fingerprint_b": b.fingerprint
+    }
+
+    # validating b doesn't lose any fingerprint
+    api_client.deployments.validate().error = None
+    b.validate()
+    assert set(group["tags"]) == {
+        "team",
+        "gpwm_fingerprint_a",
+        "gpwm_fingerprint_b"
+    }
+
+    # so neither deployment is updated again
+    deployment("a").upsert()
+    deployment("b").upsert()
+    assert api_client.deployments.create_or_update.call_count == 2
@@ -0,0 +1,72 @@
+""" Startup benchmarks
+
+Each benchmark runs in a fresh interpreter, so modules already imported by
+the test session don't hide the real import cost. The time budget (seconds)
+can be tuned for slow machines with GPWM_STARTUP_BUDGET.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+STARTUP_BUDGET = float(os.environ.get("GPWM_STARTUP_BUDGET", "1.5"))
+
+BENCHMARK = """
+import contextlib
+import io
+import sys
+import time
+
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+{code}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(" ".join(sorted({{m.split(".")[0] for m in sys.modules}})))
+"""
+
+HELP = """
+    import gpwm.cli
+    try:
+        gpwm.cli.parse_args(["--help"])
+    except SystemExit:
+        pass
+"""
+
+AWS_RENDER = """
+    import gpwm.cli
+    stack = gpwm.stacks.factory(
+        StackName="my-stack",
+        BuildId="1",
+        TemplateBody="examples/consumables/aws/network/vpc.mako",
+        Parameters={
+            "team": "networking",
+            "environment": "prod",
+            "cidr": "10.0.0.0/16",
+            "nat_availability_zones": [{"name": "a", "cidr": "10.0.0.0/28"}]
+        }
+    )
+    stack.render()
+"""
+
+
+def run_benchmark(code):
+    output = subprocess.run(
+        [sys.executable, "-c", BENCHMARK.format(code=code)],
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True
+    ).stdout.splitlines()
+    return float(output[-2]), set(output[-1].split())
+
+
+@pytest.mark.parametrize("code, not_imported", [
+    (HELP, {"apiclient", "googleapiclient", "azure", "boto3", "botocore"}),
+    (AWS_RENDER, {"apiclient", "googleapiclient", "azure"})
+], ids=["help", "aws-render"])
+def test_startup(code, not_imported):
+    elapsed, modules = run_benchmark(code)
+    assert not modules & not_imported
+    assert elapsed < STARTUP_BUDGET
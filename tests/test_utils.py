@@ -0,0 +1,408 @@
+import concurrent.futures
+import datetime
+import json
+import time
+
+import pytest
+import yaml
+
+import gpwm.utils
+
+
+@pytest.fixture(autouse=True)
+def stack_cache(mocker):
+    mocker.patch.dict("gpwm.utils.STACK_CACHE", clear=True)
+    return gpwm.utils.STACK_CACHE
+
+
+@pytest.fixture
+def cfn_client(mocker):
+    mocker.patch(
+        "gpwm.utils.get_aws_account_scope",
+        return_value=("123456789012", "us-west-2")
+    )
+    client = mocker.patch("gpwm.utils.AWSSession").return_value.client
+    client.describe_stacks.return_value = {
+        "Stacks": [{
+            "StackName": "vpc",
+            "CreationTime": datetime.datetime(2018, 1, 1),
+            "Outputs": [{"OutputKey": "VPC", "OutputValue": "vpc-1"}]
+        }]
+    }
+    return client
+
+
+@pytest.fixture
+def gcp_client(mocker):
+    client = mocker.patch("gpwm.utils.GCPSession").return_value.client
+    client.deployments().get().execute.return_value = {
+        "fingerprint": "abc",
+        "manifest": "projects/p/global/deployments/d/manifests/m-1"
+    }
+    client.manifests().get().execute.return_value = {
+        "layout": "outputs:\n- {name: vpc, finalValue: vpc-1}\n"
+    }
+    client.manifests.reset_mock()
+    return client
+
+
+def test_get_aws_stack_output(cfn_client, stack_cache):
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+    assert gpwm.utils.get_aws_stack_output("vpc", "Nope") is None
+    cfn_client.describe_stacks.assert_called_once_with(StackName="vpc")
+
+
+def test_get_aws_stack_output_concurrent(cfn_client, mocker):
+    def describe_stacks(**kwargs):
+        time.sleep(0.05)
+        return cfn_client.describe_stacks.return_value
+
+    cfn_client.describe_stacks.side_effect = describe_stacks
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        outputs = list(pool.map(
+            lambda i: gpwm.utils.get_stack_output("vpc", "VPC"),
+            range(8)
+        ))
+    assert outputs == ["vpc-1"] * 8
+    assert gpwm.utils.get_stack_output("vpc", "Nope") == ""
+    cfn_client.describe_stacks.assert_called_once()
+
+
+def test_output_cache_validate(cfn_client, stack_cache, monkeypatch):
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE", "validate")
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+
+    # same stack update time: the cached outputs are used
+    stack = cfn_client.describe_stacks.return_value["Stacks"][0]
+    stack["Outputs"][0]["OutputValue"] = "vpc-2"
+    stack_cache.clear()
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+
+    # stack updated: the outputs are refreshed
+    stack["LastUpdatedTime"] = datetime.datetime(2018, 2, 1)
+    stack["StackStatus"] = "UPDATE_IN_PROGRESS"
+    stack_cache.clear()
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-2"
+    assert cfn_client.describe_stacks.call_count == 3
+
+    # outputs read during the update are refreshed once it completes
+    stack["Outputs"][0]["OutputValue"] = "vpc-3"
+    stack["StackStatus"] = "UPDATE_COMPLETE"
+    stack_cache.clear()
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-3"
+
+
+def test_output_cache_ttl(cfn_client, stack_cache, monkeypatch):
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE", "ttl")
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+    stack_cache.clear()
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+    cfn_client.describe_stacks.assert_called_once()
+
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE_TTL", "-1")
+    stack_cache.clear()
+    gpwm.utils.get_aws_stack_output("vpc", "VPC")
+    assert cfn_client.describe_stacks.call_count == 2
+
+
+def test_output_cache_invalid_mode(cfn_client, monkeypatch):
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE", "always")
+    with pytest.raises(SystemExit):
+        gpwm.utils.get_aws_stack_output("vpc", "VPC")
+
+
+def test_get_gcp_stack_output(gcp_client, stack_cache, monkeypatch):
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE", "validate")
+    assert gpwm.utils.get_gcp_stack_output("p", "d", "vpc") == "vpc-1"
+    stack_cache.clear()
+    assert gpwm.utils.get_gcp_stack_output("p", "d", "vpc") == "vpc-1"
+
+    # the manifest is only fetched when the fingerprint changes
+    gcp_client.manifests().get.assert_called_once_with(
+        project="p",
+        deployment="d",
+        manifest="m-1"
+    )
+
+
+def test_resolve_tags(mocker):
+    document = yaml.load("""
+Parameters:
+  vpc: !Cloudformation {stack: vpc, output: VPC}
+  cidr: !Cloudformation {stack: vpc, output: CIDR}
+  subnets:
+    - !Cloudformation {stack: subnet, output: a}
+    - !Cloudformation {stack: subnet, output: b}
+  password: !SSM {Name: /db/password, WithDecryption: true}
+  same_password: !SSM {WithDecryption: true, Name: /db/password}
+  ref: !Ref something
+""")
+    assert isinstance(document["Parameters"]["vpc"], gpwm.utils.DeferredTag)
+
+    outputs = {
+        "vpc": {"VPC": "vpc-1", "CIDR": "10.0.0.0/16"},
+        "subnet": {"a": "subnet-a", "b": "subnet-b"}
+    }
+    get_outputs = mocker.patch(
+        "gpwm.utils.get_aws_stack_outputs",
+        side_effect=lambda stack: outputs[stack]
+    )
+    call_aws = mocker.patch("gpwm.utils.call_aws")
+    call_aws.return_value = {"Parameter": {"Value": "secret"}}
+
+    parameters = gpwm.utils.resolve_tags(document)["Parameters"]
+    assert parameters["vpc"] == "vpc-1"
+    assert parameters["cidr"] == "10.0.0.0/16"
+    assert parameters["subnets"] == ["subnet-a", "subnet-b"]
+    assert parameters["password"] == parameters["same_password"] == "secret"
+    assert isinstance(parameters["ref"], yaml.nodes.ScalarNode)
+    assert get_outputs.call_count == 2
+    call_aws.assert_called_once()
+
+
+def test_resolve_tags_exception(mocker):
+    document = yaml.load("""
+a: !Cloudformation {stack: vpc}
+b: !Cloudformation {stack: subnet, output: a}
+""")
+    mocker.patch("gpwm.utils.get_aws_stack_outputs", return_value={})
+    with pytest.raises(SystemExit):
+        gpwm.utils.resolve_tags(document)
+
+
+def test_resolve_tags_nested(mocker):
+    document = gpwm.utils.load_yaml("""
+vpc: !Cloudformation {stack: !SSM {Name: /network/stack}, output: VPC}
+subnets:
+  - !Cloudformation
+    stack: !SSM {Name: !SSM {Name: /network/stack-parameter}}
+    output: Subnet
+""")
+    parameters = {
+        "/network/stack-parameter": "/network/stack",
+        "/network/stack": "vpc"
+    }
+    call_aws = mocker.patch(
+        "gpwm.utils.call_aws",
+        side_effect=lambda service, action, arguments, *args: {
+            "Parameter": {"Value": parameters[arguments["Name"]]}
+        }
+    )
+    get_outputs = mocker.patch(
+        "gpwm.utils.get_aws_stack_outputs",
+        return_value={"VPC": "vpc-1", "Subnet": "subnet-1"}
+    )
+
+    resolved = gpwm.utils.resolve_tags(document)
+    assert resolved == {"vpc": "vpc-1", "subnets": ["subnet-1"]}
+    get_outputs.assert_called_once_with("vpc")
+    assert call_aws.call_count == 2
+
+
+def test_dump_json():
+    document = gpwm.utils.load_yaml("""
+Version: 2010-09-09
+Resources:
+  bucket:
+    Properties:
+      Name: !Sub "${AWS::StackName}-logs"
+      Arn: !GetAtt role.Arn
+      Tags: !Join ["-", [!Ref a, {b: !GetAtt b.Arn}, 1, true]]
+""")
+    assert json.loads(gpwm.utils.dump_json(document)) == {
+        "Version": "2010-09-09",
+        "Resources": {"bucket": {"Properties": {
+            "Name": {"Fn::Sub": "${AWS::StackName}-logs"},
+            "Arn": {"Fn::GetAtt": ["role", "Arn"]},
+            "Tags": {"Fn::Join": [
+                "-",
+                [{"Ref": "a"}, {"b": {"Fn::GetAtt": ["b", "Arn"]}}, 1, True]
+            ]}
+        }}}
+    }
+    assert " " not in gpwm.utils.dump_json({"a": [1, 2]})
+
+
+def test_resolve_tags_ssm_batch(mocker):
+    names = [f"/app/{i}" for i in range(12)]
+    document = {
+        "plain": [gpwm.utils.DeferredTag("!SSM", {"Name": n}) for n in names],
+        "again": gpwm.utils.DeferredTag("!SSM", {"Name": "/app/0"}),
+        "secret": gpwm.utils.DeferredTag(
+            "!SSM",
+            {"Name": "/db/password", "WithDecryption": True}
+        )
+    }
+
+    def get_parameters(service, action, arguments):
+        if action == "get_parameter":
+            return {"Parameter": {"Value": "secret"}}
+        assert len(arguments["Names"]) <= 10
+        prefix = "secret-" if arguments["WithDecryption"] else ""
+        return {
+            "Parameters": [
+                {"Name": n, "Value": f"{prefix}{n}"}
+                for n in arguments["Names"] if n != "/app/11"
+            ],
+            "InvalidParameters": [
+                n for n in arguments["Names"] if n == "/app/11"
+            ]
+        }
+
+    call_aws = mocker.patch("gpwm.utils.call_aws", side_effect=get_parameters)
+    with pytest.raises(SystemExit, match="not found: /app/11"):
+        gpwm.utils.resolve_tags(document)
+
+    document["plain"].pop()
+    call_aws.reset_mock()
+    resolved = gpwm.utils.resolve_tags(document)
+    assert resolved["plain"] == names[:11]
+    assert resolved["again"] == "/app/0"
+    assert resolved["secret"] == "secret"
+    # 11 plain names in 2 calls, and the secret on its own
+    assert call_aws.call_count == 3
+
+
+@pytest.fixture
+def aws_client(mocker):
+    mocker.patch.dict("gpwm.utils.AWS_CALL_CACHE", clear=True)
+    mocker.patch(
+        "gpwm.utils.get_aws_account_scope",
+        return_value=("123456789012", "us-west-2")
+    )
+    client = mocker.patch("gpwm.utils.AWSClients").return_value.get()
+    client.meta.region_name = "us-west-2"
+    client.describe_vpcs.return_value = {
+        "Vpcs": [{"VpcId": "vpc-1", "CidrBlock": "10.0.0.0/16"}],
+        "ResponseMetadata": {"RequestId": "abc"}
+    }
+    return client
+
+
+def test_call_aws_cache(aws_client, monkeypatch):
+    filters = {"Filters": [{"Name": "tag:team", "Values": ["a"]}]}
+    assert gpwm.utils.call_aws(
+        "ec2", "describe_vpcs", filters, "Vpcs[0].VpcId"
+    ) == "vpc-1"
+    assert gpwm.utils.call_aws(
+        "ec2", "describe_vpcs", filters, "Vpcs[0].CidrBlock"
+    ) == "10.0.0.0/16"
+    aws_client.describe_vpcs.assert_called_once()
+
+    gpwm.utils.call_aws("ec2", "describe_vpcs", filters, cache=False)
+    gpwm.utils.call_aws("ec2", "describe_vpcs", {})
+    assert aws_client.describe_vpcs.call_count == 3
+
+    # mutating actions are never cached
+    gpwm.utils.call_aws("ec2", "create_vpc", {"CidrBlock": "10.0.0.0/16"})
+    gpwm.utils.call_aws("ec2", "create_vpc", {"CidrBlock": "10.0.0.0/16"})
+    assert aws_client.create_vpc.call_count == 2
+
+    # nor non-deterministic ones
+    for i in range(2):
+        gpwm.utils.call_aws("secretsmanager", "get_random_password")
+    assert aws_client.get_random_password.call_count == 2
+
+    monkeypatch.setenv("GPWM_AWS_NEVER_CACHE", "ec2:describe_subnets")
+    gpwm.utils.call_aws("ec2", "describe_subnets")
+    gpwm.utils.call_aws("ec2", "describe_subnets")
+    assert aws_client.describe_subnets.call_count == 2
+
+
+def test_call_aws_disk_cache(aws_client, monkeypatch):
+    monkeypatch.setenv("GPWM_AWS_CACHE_TTL", "300")
+    gpwm.utils.call_aws("ec2", "describe_vpcs")
+    gpwm.utils.AWS_CALL_CACHE.clear()
+    assert gpwm.utils.call_aws("ec2", "describe_vpcs") == {
+        "Vpcs": [{"VpcId": "vpc-1", "CidrBlock": "10.0.0.0/16"}]
+    }
+    aws_client.describe_vpcs.assert_called_once()
+
+    # secrets aren't written to disk
+    aws_client.get_parameter.return_value = {"Parameter": {"Value": "x"}}
+    for i in range(2):
+        gpwm.utils.AWS_CALL_CACHE.clear()
+        gpwm.utils.call_aws(
+            "ssm",
+            "get_parameter",
+            {"Name": "/db/password", "WithDecryption": True}
+        )
+    assert aws_client.get_parameter.call_count == 2
+
+
+def test_get_stack_resource(cfn_client):
+    cfn_client.get_paginator.return_value.paginate.return_value = [
+        {"StackResourceSummaries": [
+            {"LogicalResourceId": f"Subnet{i}", "PhysicalResourceId": f"s-{i}"}
+            for i in range(page * 100, page * 100 + 100)
+        ]} for page in range(2)
+    ]
+    document = {
+        f"subnet{i}": gpwm.utils.DeferredTag(
+            "!Cloudformation",
+            {"stack": "subnets", "resource_id": f"Subnet{i}"}
+        ) for i in range(0, 200, 10)
+    }
+    resolved = gpwm.utils.resolve_tags(document)
+    assert resolved["subnet190"] == "s-190"
+    cfn_client.get_paginator.assert_called_once_with("list_stack_resources")
+    cfn_client.get_paginator().paginate.assert_called_once_with(
+        StackName="subnets"
+    )
+
+    with pytest.raises(SystemExit, match="Nope not found"):
+        gpwm.utils.get_stack_resource("subnets", "Nope")
+
+
+def test_export_index(cfn_client, monkeypatch):
+    monkeypatch.setenv("GPWM_EXPORT_INDEX", "1")
+    cfn_client.get_paginator.return_value.paginate.return_value = [
+        {"Exports": [{"Name": f"vpc{i}-VPC", "Value": f"vpc-{i}"}]}
+        for i in range(15)
+    ]
+    document = {
+        f"vpc{i}": gpwm.utils.DeferredTag(
+            "!Cloudformation",
+            {"stack": f"vpc{i}", "output": "VPC"}
+        ) for i in range(15)
+    }
+    document["not_exported"] = gpwm.utils.DeferredTag(
+        "!Cloudformation",
+        {"stack": "vpc", "output": "VPC"}
+    )
+    resolved = gpwm.utils.resolve_tags(document)
+    assert resolved["vpc14"] == "vpc-14"
+    assert resolved["not_exported"] == "vpc-1"
+    cfn_client.get_paginator.assert_called_once_with("list_exports")
+    cfn_client.describe_stacks.assert_called_once_with(StackName="vpc")
+
+    # the index is rebuilt once a stack of the batch changed
+    gpwm.utils.forget_stack("vpc3")
+    assert ("aws-exports", None) not in gpwm.utils.STACK_CACHE
+    assert ("aws", None, "vpc") in gpwm.utils.STACK_CACHE
+    gpwm.utils.get_aws_stack_output("vpc3", "VPC")
+    assert cfn_client.get_paginator.call_count == 2
+
+
+def test_forget_stack_output_cache(cfn_client, monkeypatch):
+    monkeypatch.setenv("GPWM_OUTPUT_CACHE", "ttl")
+    monkeypatch.setenv("GPWM_EXPORT_INDEX", "1")
+    cfn_client.get_paginator.return_value.paginate.return_value = [
+        {"Exports": [{"Name": "vpc-VPC", "Value": "vpc-1"}]}
+    ]
+    assert gpwm.utils.get_aws_stack_output("vpc", "VPC") == "vpc-1"
+    assert gpwm.utils.get_aws_stack_output("vpc", "CIDR") is None
+    cache, ttl = gpwm.utils.get_output_cache(
+        "aws",
+        "123456789012",
+        "us-west-2"
+    )
+    cache.set("subnet", {"stamp": "1", "outputs": {"a": "subnet-a"}})
+    assert cache.get("exports") and cache.get("vpc")
+
+    # a batch changed vpc: the stacks depending on it mustn't read its old
+    # outputs, nor the old exports, from disk
+    gpwm.utils.forget_stack("vpc")
+    assert cache.get("exports") is None
+    assert cache.get("vpc") is None
+    assert cache.get("subnet")